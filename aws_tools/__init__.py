@@ -0,0 +1 @@
+'''Shared code of the aws-tools scripts'''
@@ -0,0 +1,34 @@
+'''Client of aws-env-agent.py, which keeps decrypted env files in memory
+
+Requests and responses are one line of JSON each over a unix socket only the
+user can open.
+'''
+
+import json
+import os
+
+from aws_tools import trace
+
+socket_path = os.path.join(os.environ["HOME"], ".aws", ".agent.sock")
+
+
+def request(msg):
+    '''Send a request to a running agent, None when there is none'''
+    if not os.path.exists(socket_path):
+        return None
+    # awsenv asks the agent on every switch, only import what talking to it needs
+    import socket
+
+    with trace.span("agent.{0}".format(msg["op"]), "agent"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(2)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(msg).encode("utf-8") + b"\n")
+            return json.loads(sock.makefile("rb").readline().decode("utf-8"))
+        except (OSError, ValueError):
+            return None
+        finally:
+            sock.close()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
@@ -0,0 +1,79 @@
+'''boto3 clients shared by the whole process
+
+Creating a client loads and parses its service model, which takes 50-150 ms.
+Every client made here comes from one boto3 session, so each model is loaded
+only once. Each (credentials, region, service) client is made only once too,
+and it keeps its connection pool. Clients are thread safe, sessions are not,
+so the session is only ever used under a lock.
+
+    >>> from aws_tools import clients
+    >>> clients.configure(max_pool_connections=32)
+    >>> ec2 = clients.client("ec2", "eu-west-1")
+    >>> iam = clients.client("iam", credentials={"aws_access_key_id": ..., "aws_secret_access_key": ...})
+'''
+
+import threading
+
+from aws_tools import trace
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_max_pool_connections = 10
+
+
+def configure(max_pool_connections=None):
+    '''Set the default connection pool size of the clients made from now on'''
+    global _max_pool_connections
+    if max_pool_connections is not None:
+        _max_pool_connections = max(1, max_pool_connections)
+
+
+def get_session():
+    '''The boto3 session all the clients are made from, with the default credentials and region'''
+    global _session
+    with _lock:
+        if _session is None:
+            # boto3 takes a while to import, only scripts which talk to AWS pay for it
+            import boto3
+            _session = boto3.session.Session()
+        return _session
+
+
+def get_credentials():
+    '''The default credentials, None when there are none'''
+    session = get_session()
+    with _lock:
+        return session.get_credentials()
+
+
+def client(service, region=None, credentials=None, max_pool_connections=None, retries=None, endpoint_url=None):
+    '''A cached boto3 client
+
+    credentials is a dict of aws_access_key_id, aws_secret_access_key and
+    optionally aws_session_token; without it the default chain is used.
+    retries is passed to botocore's Config, e.g. {"mode": "standard", "total_max_attempts": 1}
+    for callers which retry on their own.
+    '''
+    pool = max_pool_connections or _max_pool_connections
+    key = (service, region, endpoint_url, pool,
+           tuple(sorted((credentials or {}).items())), tuple(sorted((retries or {}).items())))
+    session = get_session()
+    with _lock:
+        cached = _clients.get(key)
+        if cached is None:
+            from botocore.config import Config
+            config = Config(max_pool_connections=pool, retries=retries) if retries else \
+                Config(max_pool_connections=pool)
+            cached = trace.instrument(session.client(service, region_name=region, endpoint_url=endpoint_url,
+                                                     config=config, **(credentials or {})))
+            _clients[key] = cached
+        return cached
+
+
+def clear():
+    '''Forget every client, e.g. after the keys they were made with are rotated'''
+    with _lock:
+        _clients.clear()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
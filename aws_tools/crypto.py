@@ -0,0 +1,104 @@
+'''GPG session shared by every decrypt/encrypt call of a process'''
+
+import getpass
+import logging
+import threading
+
+from aws_tools import trace
+
+log = logging.getLogger(__name__)
+
+DECRYPTION_OK = 'decryption ok'
+
+
+class CryptoError(Exception):
+    '''Raised when gpg can't decrypt or encrypt something'''
+
+
+class CryptoSession(object):
+    '''Resolves the keyring and the recipient once, then decrypts and encrypts
+    any number of payloads with the same passphrase (or gpg agent).
+
+    Every gpg subprocess costs tens of milliseconds, so the private key list
+    is asked for only once per process and the passphrase is checked once up
+    front instead of failing on every file.
+    '''
+
+    def __init__(self, use_agent=False, gpg_binary=None,
+                 prompt="Please enter passphrase for decrypting env files: "):
+        import gnupg
+
+        if gpg_binary is not None:
+            self.gpg = gnupg.GPG(use_agent=use_agent, gpgbinary=gpg_binary)
+        else:
+            self.gpg = gnupg.GPG(use_agent=use_agent)
+        self.gpg.encoding = 'utf-8'
+        self.use_agent = use_agent
+        self.prompt = prompt
+        self.passphrase = None
+        self.unlocked = False
+        self._private_keys = None
+        self._lock = threading.Lock()
+
+    @property
+    def private_keys(self):
+        with self._lock:
+            if self._private_keys is None:
+                with trace.span("gpg.list_keys", "gpg"):
+                    self._private_keys = self.gpg.list_keys(True)
+                if not self._private_keys:
+                    log.error('No private key(s) found! Please check your GPG config')
+        return self._private_keys
+
+    @property
+    def recipient(self):
+        if not self.private_keys:
+            raise CryptoError('No private key to encrypt for')
+        return self.private_keys[0]['uids'][0]
+
+    def unlock(self, path, attempts=3):
+        '''Ask for the passphrase and check it on `path`, return its decrypted contents'''
+        for attempt in range(attempts):
+            if not self.use_agent:
+                self.passphrase = getpass.getpass(self.prompt)
+            try:
+                decrypted = self.decrypt_file(path)
+                self.unlocked = True
+                return decrypted
+            except CryptoError as exc:
+                if self.use_agent or attempt == attempts - 1:
+                    raise
+                log.error('{0}, check your password'.format(exc))
+
+    def decrypt_file(self, path):
+        if not self.private_keys:
+            raise CryptoError('No private key to decrypt {0}'.format(path))
+        with open(path, 'rb') as stream, trace.span("gpg.decrypt", "gpg", path=path):
+            output = self.gpg.decrypt_file(stream, passphrase=self.passphrase)
+        if output.status != DECRYPTION_OK:
+            raise CryptoError('Unable to decrypt {0}'.format(path))
+        return str(output)
+
+    def decrypt_files(self, paths, jobs=1):
+        '''Decrypt files side by side, one gpg process each; None for the ones which fail'''
+        from concurrent.futures import ThreadPoolExecutor
+
+        def decrypt(path):
+            try:
+                return path, self.decrypt_file(path)
+            except (CryptoError, IOError) as exc:
+                log.error(exc)
+                return path, None
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            return dict(pool.map(decrypt, paths))
+
+    def encrypt(self, contents):
+        recipient = self.recipient
+        with trace.span("gpg.encrypt", "gpg"):
+            encrypted = self.gpg.encrypt(contents, recipient)
+        if not encrypted.ok:
+            raise CryptoError('Unable to encrypt: {0}'.format(encrypted.status))
+        return str(encrypted)
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
@@ -0,0 +1,61 @@
+'''The encrypted envs in ~/.aws and the index of them the scripts and the shell share
+
+~/.aws/.envs holds the env names and the active env. It is good as long as
+it is strictly newer than ~/.aws, which changes whenever an env file is added
+or removed, so the envs don't have to be listed on every run.
+'''
+
+import logging
+import os
+import re
+
+aws_config_dir = os.path.join(os.environ["HOME"], ".aws")
+env_file = os.path.join(aws_config_dir, ".env")
+index_file = os.path.join(aws_config_dir, ".envs")
+
+
+def read_index():
+    '''Env names and the active env from ~/.aws/.envs, None unless it is newer than ~/.aws'''
+    try:
+        # an env file added within the same timestamp tick as the index write leaves both
+        # times equal, the index can't tell whether it saw that file
+        if os.stat(aws_config_dir).st_mtime_ns >= os.stat(index_file).st_mtime_ns:
+            return None
+        with open(index_file, "r") as index_in:
+            fields = dict(line.rstrip("\n").partition(" ")[::2] for line in index_in)
+    except (IOError, OSError):
+        return None
+    return fields.get("envs", "").split(), fields.get("active", "")
+
+
+def write_index(envs, active):
+    # rewrite it in place, replacing the file would touch ~/.aws and make the index stale right away
+    try:
+        with open(index_file, "w") as index_out:
+            index_out.write("active {0}\nenvs {1}\n".format(active, " ".join(envs)))
+    except (IOError, OSError) as exc:
+        logging.debug("Unable to write {0}: {1}".format(index_file, exc))
+
+
+def list_envs():
+    return sorted(
+        map(lambda file: re.sub(r"^env.(.*).conf.asc$", r"\1", file),
+            filter(lambda file: file.startswith("env") and file.endswith(".conf.asc"),
+                   os.listdir(aws_config_dir))))
+
+
+def get_available_envs():
+    '''Env names, listing ~/.aws only when it changed since the index was written'''
+    index = read_index()
+    if index is not None:
+        return index[0]
+    envs = list_envs()
+    try:
+        with open(env_file, "r") as env_in:
+            active = env_in.read().strip()
+    except IOError:
+        active = ""
+    write_index(envs, active)
+    return envs
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
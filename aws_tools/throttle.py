@@ -0,0 +1,80 @@
+'''Rate limiting and backoff shared by the scripts which fan out AWS calls'''
+
+import random
+import threading
+import time
+
+from aws_tools import trace
+
+THROTTLING_ERRORS = ("Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException",
+                     "SlowDown")
+# retried by botocore's standard mode besides 5xx responses
+TRANSIENT_ERRORS = ("RequestTimeout", "RequestTimeoutException", "PriorRequestNotComplete")
+
+
+class TokenBucket(object):
+    '''Lets through `rate` calls per second on average, in bursts of up to `burst` calls'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            with trace.span("rate_limit"):
+                time.sleep(wait)
+
+
+def is_throttled(exc):
+    '''True when a botocore ClientError says the caller is going too fast'''
+    response = getattr(exc, "response", None) or {}
+    return response.get("Error", {}).get("Code") in THROTTLING_ERRORS
+
+
+def is_transient(exc):
+    '''True when a call may well go through if it is tried again: throttling, 5xx and dropped connections'''
+    if is_throttled(exc):
+        return True
+    response = getattr(exc, "response", None) or {}
+    if response.get("Error", {}).get("Code") in TRANSIENT_ERRORS or \
+            response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500:
+        return True
+    # only ever called once a client raised, botocore is loaded by then
+    from botocore.exceptions import ConnectionError, HTTPClientError
+    return isinstance(exc, (ConnectionError, HTTPClientError))
+
+
+def backoff(attempt, cap=20):
+    # full jitter, see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    with trace.span("backoff", attempt=attempt):
+        time.sleep(random.uniform(0, min(cap, 0.5 * 2 ** attempt)))
+
+
+def call_with_retry(call, bucket, retries, on_call=None):
+    '''Run call() within the rate limit, retrying it while it fails with a transient error
+
+    on_call(attempt) is called before every try, the first one is attempt 0.
+    '''
+    for attempt in range(retries + 1):
+        bucket.take()
+        if on_call is not None:
+            on_call(attempt)
+        try:
+            return call()
+        except Exception as exc:
+            if not is_transient(exc) or attempt == retries:
+                raise
+        backoff(attempt)
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
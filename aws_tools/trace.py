@@ -0,0 +1,182 @@
+'''Timing of AWS calls, gpg and SMTP for the --trace option of the scripts
+
+Nothing is recorded until enable() is called. At exit a latency table of every
+operation is printed to stderr and, when a file was given, the timeline is
+saved to it: JSON lines when it ends with .jsonl, otherwise the Chrome trace
+format which chrome://tracing and https://ui.perfetto.dev open.
+'''
+
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.01, 0.1, 1, 10, float("inf"))
+BUCKET_NAMES = ("<1ms", "<10ms", "<100ms", "<1s", "<10s", ">=10s")
+
+_tracer = None
+
+
+class Tracer(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self.started = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, name, category, start, duration=None, **args):
+        event = {"name": name, "cat": category, "ts": round((start - self.started) * 1e6),
+                 "pid": os.getpid(), "tid": threading.get_ident()}
+        if duration is None:
+            event.update(ph="i", s="t")
+        else:
+            event.update(ph="X", dur=round(duration * 1e6))
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+
+    def before_call(self, model, context, **kwargs):
+        context["trace_start"] = time.perf_counter()
+        # after-call-error isn't given the model, only the context
+        context["trace_operation"] = operation_name(model)
+
+    def after_call(self, model, context, parsed=None, **kwargs):
+        start = context.pop("trace_start", None)
+        if start is None:
+            return
+        args = {}
+        error = (parsed or {}).get("Error", {}).get("Code")
+        if error:
+            args["error"] = error
+        self.add(operation_name(model), "aws", start, time.perf_counter() - start, **args)
+
+    def after_call_error(self, context, exception=None, **kwargs):
+        start = context.pop("trace_start", None)
+        if start is not None:
+            self.add(context.get("trace_operation", "aws"), "aws", start, time.perf_counter() - start,
+                     error=type(exception).__name__)
+
+    def request_created(self, request, **kwargs):
+        # a request is made for every attempt, the ones after the first are retries
+        context = getattr(request, "context", None)
+        if context is None or "trace_operation" not in context:
+            return
+        context["trace_attempts"] = context.get("trace_attempts", 0) + 1
+        if context["trace_attempts"] > 1:
+            self.add("{0} retry".format(context["trace_operation"]), "aws", time.perf_counter(),
+                     attempt=context["trace_attempts"])
+
+    def summary(self):
+        '''Latency of every operation: {name: sorted durations in seconds, errors}'''
+        ops = {}
+        with self.lock:
+            for event in self.events:
+                if event["ph"] != "X":
+                    continue
+                durations, errors = ops.setdefault(event["name"], ([], [0]))
+                durations.append(event["dur"] / 1e6)
+                if "error" in event.get("args", {}):
+                    errors[0] += 1
+        return {name: (sorted(durations), errors[0]) for name, (durations, errors) in ops.items()}
+
+    def print_summary(self, out=sys.stderr):
+        ops = self.summary()
+        if not ops:
+            return
+        width = max(len(name) for name in ops)
+        header = "{0:<{w}} {1:>7} {2:>6} {3:>9} {4:>9} {5:>9} {6:>9}".format(
+            "operation", "calls", "errors", "total s", "p50 ms", "p95 ms", "max ms", w=width)
+        out.write("{0}  {1}\n".format(header, " ".join("{0:>7}".format(name) for name in BUCKET_NAMES)))
+        # the slowest operations in total first, that's where the time goes
+        for name, (durations, errors) in sorted(ops.items(), key=lambda op: -sum(op[1][0])):
+            histogram = [0] * len(BUCKETS)
+            for duration in durations:
+                histogram[next(n for n, bound in enumerate(BUCKETS) if duration < bound)] += 1
+            out.write("{0:<{w}} {1:>7} {2:>6} {3:>9.3f} {4:>9.1f} {5:>9.1f} {6:>9.1f}  {7}\n".format(
+                name, len(durations), errors, sum(durations), percentile(durations, 50) * 1e3,
+                percentile(durations, 95) * 1e3, durations[-1] * 1e3,
+                " ".join("{0:>7}".format(count) for count in histogram), w=width))
+        out.write("wall time {0:.3f}s\n".format(time.perf_counter() - self.started))
+
+    def save(self):
+        with self.lock:
+            events = list(self.events)
+        with open(self.path, "w") as out:
+            if self.path.endswith(".jsonl"):
+                for event in events:
+                    out.write(json.dumps(event) + "\n")
+            else:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out)
+
+    def finish(self):
+        self.print_summary()
+        if self.path:
+            try:
+                self.save()
+            except (IOError, OSError) as exc:
+                sys.stderr.write("Unable to save the trace to {0}: {1}\n".format(self.path, exc))
+
+
+def operation_name(model):
+    return "{0}.{1}".format(model.service_model.service_name, model.name)
+
+
+def percentile(durations, pct):
+    return durations[min(len(durations) - 1, int(len(durations) * pct / 100))]
+
+
+def enable(path=None):
+    '''Start recording, the report is written when the process exits'''
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(path or None)
+        atexit.register(_tracer.finish)
+    return _tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def argv(args=None):
+    '''Command line arguments with a bare --trace turned into --trace=
+
+    The file can only be given as --trace=<file>, so --trace never takes the
+    next argument, e.g. a subcommand, for its file.
+    '''
+    return ["--trace=" if arg == "--trace" else arg for arg in (sys.argv[1:] if args is None else args)]
+
+
+def instrument(client):
+    '''Time every call of a boto3 client, and its retries'''
+    if _tracer is not None:
+        events = client.meta.events
+        events.register("before-call", _tracer.before_call)
+        events.register("after-call", _tracer.after_call)
+        events.register("after-call-error", _tracer.after_call_error)
+        events.register("request-created", _tracer.request_created)
+    return client
+
+
+@contextlib.contextmanager
+def span(name, category="local", **args):
+    '''Time the block as `name`, an error raised in it is recorded too'''
+    if _tracer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as exc:
+        args["error"] = type(exc).__name__
+        raise
+    finally:
+        _tracer.add(name, category, start, time.perf_counter() - start, **args)
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+'''Benchmarks the bin/ scripts against a local moto server and a throwaway GPG home
+
+Every script runs in its own process through probe.py, which counts its AWS
+calls and gpg processes and measures its peak RSS. Wall and CPU time are taken
+from the process.
+
+Usage:
+    $ pip install -r benchmarks/requirements.txt
+    $ python benchmarks/bench.py -o before.json
+    $ python benchmarks/bench.py -o after.json --compare before.json
+'''
+
+import argparse
+import datetime
+import json
+import logging as log
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import boto3
+import gnupg
+import moto
+from moto.server import ThreadedMotoServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIN = os.path.join(ROOT, "bin")
+PROBE = os.path.join(ROOT, "benchmarks", "probe.py")
+REGION = "us-east-1"
+SCENARIOS = ("list-ec2", "clean-eb", "envs")
+
+CREDENTIALS_FILE_TPL = """
+[default]
+aws_access_key_id = {id}
+aws_secret_access_key = {key}
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser(__file__, description="Benchmark aws-tools against a local AWS stand-in")
+    # no choices, argparse rejects an empty list against them
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="What to run, any of {0} (default: everything)".format(", ".join(SCENARIOS)))
+    parser.add_argument("-s", "--scale", type=float, default=1.0,
+                        help="Multiplies the data volumes: 50k instances, 200 apps x 100 versions, 100 envs (default: 1)")
+    parser.add_argument("-o", "--out", help="Where to save the JSON results (default: stdout)")
+    parser.add_argument("-c", "--compare", help="Earlier JSON results to compare with")
+    parser.add_argument("-k", "--keep", action="store_true", help="Keep the temporary HOME and GPG home")
+    parser.add_argument("-d", "--debug", action="store_true", help="Debug mode")
+    args = parser.parse_args()
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenario(s): {0}, choose from {1}".format(", ".join(unknown), ", ".join(SCENARIOS)))
+    return args
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Bench(object):
+    '''Temporary HOME, GPG home and moto server shared by the scenarios'''
+
+    def __init__(self, scale, endpoint, workdir):
+        self.scale = scale
+        self.endpoint = endpoint
+        self.workdir = workdir
+        self.home = os.path.join(workdir, "home")
+        self.aws_config_dir = os.path.join(self.home, ".aws")
+        os.makedirs(self.aws_config_dir)
+        gnupghome = os.path.join(workdir, "gnupg")
+        os.makedirs(gnupghome, 0o700)
+
+        self.env = dict(os.environ, HOME=self.home, GNUPGHOME=gnupghome, AWS_ENDPOINT_URL=endpoint,
+                        AWS_ACCESS_KEY_ID="testing", AWS_SECRET_ACCESS_KEY="testing",
+                        AWS_DEFAULT_REGION=REGION, PYTHONPATH=ROOT)
+        for name in ("AWS_PROFILE", "AWS_SESSION_TOKEN", "AWS_ENV"):
+            self.env.pop(name, None)
+
+        self.session = boto3.session.Session(aws_access_key_id="testing", aws_secret_access_key="testing",
+                                             region_name=REGION)
+        self.gpg = gnupg.GPG(gnupghome=gnupghome)
+        key = self.gpg.gen_key(self.gpg.gen_key_input(key_type="RSA", key_length=2048, no_protection=True,
+                                                      name_email="bench@example.com"))
+        self.recipient = str(key)
+
+    def client(self, service):
+        return self.session.client(service, endpoint_url=self.endpoint)
+
+    def count(self, full):
+        return max(1, int(full * self.scale))
+
+    def run(self, name, script, args, extra_env=None):
+        '''Run a script through the probe, return its measurements'''
+        counts_file = os.path.join(self.workdir, "counts.json")
+        log_file = os.path.join(self.workdir, "{0}.log".format(name))
+        cmd = [sys.executable, PROBE, counts_file, os.path.join(BIN, script)] + args
+        log.info("Running %s: %s", name, " ".join([script] + args))
+
+        with open(log_file, "wb") as stderr:
+            started = time.monotonic()
+            proc = subprocess.Popen(cmd, env=dict(self.env, **(extra_env or {})), cwd=self.workdir,
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+            # wait4 gives the CPU time of this very process, not of all children so far. Its
+            # ru_maxrss would include the peak of bench.py itself, probe.py measures memory
+            _, status, usage = os.wait4(proc.pid, 0)
+            wall = time.monotonic() - started
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+        try:
+            with open(counts_file, "r") as counts_in:
+                counts = json.load(counts_in)
+            os.unlink(counts_file)
+        except (IOError, ValueError):
+            counts = {"api_calls": {}, "gpg_processes": None, "peak_rss_kb": None}
+        if proc.returncode != 0:
+            log.warning("%s exited with %s, see %s", name, proc.returncode, log_file)
+
+        return {
+            "name": name,
+            "command": [script] + args,
+            "exit_code": proc.returncode,
+            "wall_s": round(wall, 3),
+            "user_s": round(usage.ru_utime, 3),
+            "sys_s": round(usage.ru_stime, 3),
+            "peak_rss_kb": counts["peak_rss_kb"],
+            "api_calls": sum(counts["api_calls"].values()),
+            "api_calls_by_operation": dict(sorted(counts["api_calls"].items())),
+            "gpg_processes": counts["gpg_processes"],
+        }
+
+    def list_ec2(self):
+        ec2 = self.client("ec2")
+        image = ec2.describe_images()["Images"][0]["ImageId"]
+        total = self.count(50000)
+        log.info("Launching %d instances", total)
+        for start in range(0, total, 1000):
+            batch = min(1000, total - start)
+            ec2.run_instances(ImageId=image, InstanceType="t3.micro", MinCount=batch, MaxCount=batch,
+                              TagSpecifications=[{"ResourceType": "instance", "Tags": [
+                                  {"Key": "Name", "Value": "bench-{0}".format(start // 1000)}]}])
+
+        args = ["-r", REGION, "-o", "jsonl"]
+        return [
+            self.run("list-ec2", "aws-list-ec2.py", args),
+            self.run("list-ec2-cache-refresh", "aws-list-ec2.py", args + ["-c", "--refresh"]),
+            self.run("list-ec2-cached", "aws-list-ec2.py", args + ["-c"]),
+        ]
+
+    def clean_eb(self):
+        # served by the stand-in in probe.py, 100 versions per app
+        stand_in = {"BENCH_EB": "{0}:100".format(self.count(200))}
+        plan = os.path.join(self.workdir, "plan.json")
+        return [
+            self.run("clean-eb-plan", "aws-clean-eb-versions.py", ["plan", "-o", plan], stand_in),
+            self.run("clean-eb", "aws-clean-eb-versions.py", ["-f", "-c", "16", "-r", "1000"], stand_in),
+        ]
+
+    def envs(self):
+        iam = self.client("iam")
+        envs = ["env{0:03d}".format(n) for n in range(self.count(100))]
+        log.info("Encrypting %d envs", len(envs))
+        for env in envs:
+            iam.create_user(UserName=env)
+            key = iam.create_access_key(UserName=env)["AccessKey"]
+            contents = CREDENTIALS_FILE_TPL.format(id=key["AccessKeyId"], key=key["SecretAccessKey"])
+            encrypted = self.gpg.encrypt(contents, self.recipient, always_trust=True)
+            with open(os.path.join(self.aws_config_dir, "env.{0}.conf.asc".format(env)), "w") as out:
+                out.write(str(encrypted))
+
+        return [
+            self.run("env-update-all-profiles", "aws-env-update.py", ["-a", "--all-profiles", "-j", "8"]),
+            self.run("env-update-all-profiles-unchanged", "aws-env-update.py", ["-a", "--all-profiles", "-j", "8"]),
+            self.run("env-update-export", "aws-env-update.py", ["-a", "-x", "-e", envs[-1]]),
+            self.run("roll-keys", "aws-roll-keys.py", ["-a", "-e", "all", "-p", "8"]),
+        ]
+
+
+def compare(old, new):
+    '''Print how every benchmark moved since the old results'''
+    before = {result["name"]: result for result in old["results"]}
+    print("{0:<36} {1:>18} {2:>16} {3:>10} {4:>20}".format("benchmark", "wall s", "api calls", "gpg", "peak rss kb"),
+          file=sys.stderr)
+    for result in new["results"]:
+        prev = before.get(result["name"])
+        if prev is None:
+            continue
+        print("{0:<36} {1:>18} {2:>16} {3:>10} {4:>20}".format(
+            result["name"],
+            "{0}->{1}".format(prev["wall_s"], result["wall_s"]),
+            "{0}->{1}".format(prev["api_calls"], result["api_calls"]),
+            "{0}->{1}".format(prev["gpg_processes"], result["gpg_processes"]),
+            "{0}->{1}".format(prev["peak_rss_kb"], result["peak_rss_kb"])), file=sys.stderr)
+
+
+def main():
+    args = get_args()
+    log.basicConfig(format="%(levelname)s: %(message)s", level=log.DEBUG if args.debug else log.INFO)
+    scenarios = args.scenarios or SCENARIOS
+
+    workdir = tempfile.mkdtemp(prefix="aws-tools-bench-")
+    port = free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    results = []
+    try:
+        bench = Bench(args.scale, "http://127.0.0.1:{0}".format(port), workdir)
+        for scenario in scenarios:
+            results.extend(getattr(bench, scenario.replace("-", "_"))())
+    finally:
+        server.stop()
+        if args.keep:
+            log.info("Kept %s", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        "meta": {
+            "created": datetime.datetime.utcnow().isoformat() + "Z",
+            "version": git_version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "boto3": boto3.__version__,
+            "moto": moto.__version__,
+            "scale": args.scale,
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump(output, out, indent=2)
+            out.write("\n")
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare, "r") as old:
+            compare(json.load(old), output)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
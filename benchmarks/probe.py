@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+'''Runs one of the bin/ scripts for bench.py, counting its AWS calls and gpg processes, and its peak RSS
+
+Usage: probe.py <counts.json> <script> [args...]
+
+Nothing is imported up front, botocore is hooked only when the script imports
+it, so import time and memory of the script itself are left alone.
+'''
+
+import collections
+import datetime
+import importlib.abc
+import importlib.util
+import json
+import os
+import runpy
+import subprocess
+import sys
+import threading
+
+lock = threading.Lock()
+counts = {"api_calls": collections.Counter(), "gpg_processes": 0}
+stand_ins = {}
+
+
+class CountingPopen(subprocess.Popen):
+    '''python-gnupg spawns gpg through subprocess.Popen, count those'''
+
+    def __init__(self, args, *rest, **kwargs):
+        cmd = args.split()[0] if isinstance(args, str) else args[0]
+        if os.path.basename(cmd).startswith("gpg"):
+            with lock:
+                counts["gpg_processes"] += 1
+        super(CountingPopen, self).__init__(args, *rest, **kwargs)
+
+
+class PatchOnImport(importlib.abc.MetaPathFinder):
+    '''Calls patch(module) right after `name` is imported by someone else'''
+
+    def __init__(self, name, patch):
+        self.name = name
+        self.patch = patch
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != self.name:
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(fullname)
+        exec_module = spec.loader.exec_module
+
+        def exec_and_patch(module):
+            exec_module(module)
+            self.patch(module)
+
+        spec.loader.exec_module = exec_and_patch
+        return spec
+
+
+def count_api_calls(client_module):
+    make_api_call = client_module.BaseClient._make_api_call
+
+    def counted(self, operation_name, api_params):
+        service = self.meta.service_model.service_name
+        with lock:
+            counts["api_calls"]["{0}.{1}".format(service, operation_name)] += 1
+        if service in stand_ins:
+            return stand_ins[service](operation_name, api_params)
+        return make_api_call(self, operation_name, api_params)
+
+    client_module.BaseClient._make_api_call = counted
+
+
+class ElasticBeanstalkStandIn(object):
+    '''Just enough of Elastic Beanstalk for aws-clean-eb-versions.py, moto keeps no application versions'''
+
+    def __init__(self, apps, versions):
+        created = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self.lock = threading.Lock()
+        self.apps = collections.OrderedDict()
+        for a in range(apps):
+            app = "app-{0:04d}".format(a)
+            self.apps[app] = collections.OrderedDict(
+                ("v{0:05d}".format(v), {
+                    "ApplicationName": app,
+                    "VersionLabel": "v{0:05d}".format(v),
+                    "DateCreated": created + datetime.timedelta(hours=v),
+                    "SourceBundle": {"S3Bucket": "eb-bundles", "S3Key": "{0}/v{1:05d}.zip".format(app, v)},
+                }) for v in range(versions))
+
+    def __call__(self, operation, params):
+        with self.lock:
+            return getattr(self, operation)(params)
+
+    def DescribeEnvironments(self, params):
+        # the oldest version of every app is deployed, so it has to survive the cleanup
+        return {"Environments": [{"ApplicationName": app, "EnvironmentName": "{0}-env".format(app),
+                                  "VersionLabel": next(iter(versions))}
+                                 for app, versions in self.apps.items() if versions]}
+
+    def DescribeApplications(self, params):
+        return {"Applications": [{"ApplicationName": app} for app in self.apps]}
+
+    def DescribeApplicationVersions(self, params):
+        if "ApplicationName" in params:
+            versions = list(self.apps.get(params["ApplicationName"], {}).values())
+        else:
+            versions = [version for app in self.apps.values() for version in app.values()]
+        start = int(params.get("NextToken", 0))
+        end = start + params.get("MaxRecords", 1000)
+        page = {"ApplicationVersions": versions[start:end]}
+        if end < len(versions):
+            page["NextToken"] = str(end)
+        return page
+
+    def DeleteApplicationVersion(self, params):
+        self.apps[params["ApplicationName"]].pop(params["VersionLabel"])
+        return {}
+
+
+def peak_rss_kb():
+    '''High-water mark of this process's resident memory, in kilobytes'''
+    # unlike ru_maxrss, VmHWM starts over on exec, it isn't bench.py's own peak
+    try:
+        with open("/proc/self/status", "r") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    import resource
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss // 1024 if sys.platform == "darwin" else maxrss
+
+
+def main():
+    counts_file, script = sys.argv[1:3]
+    sys.argv = sys.argv[2:]
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+
+    subprocess.Popen = CountingPopen
+    sys.meta_path.insert(0, PatchOnImport("botocore.client", count_api_calls))
+    if os.environ.get("BENCH_EB"):
+        stand_ins["elasticbeanstalk"] = ElasticBeanstalkStandIn(*map(int, os.environ["BENCH_EB"].split(":")))
+
+    code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as exc:
+        code = exc.code if isinstance(exc.code, int) else (0 if exc.code is None else 1)
+    finally:
+        counts["peak_rss_kb"] = peak_rss_kb()
+        with open(counts_file, "w") as out:
+            json.dump(counts, out)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
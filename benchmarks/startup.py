@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+'''Checks how fast the bin/ scripts start, with python -X importtime
+
+awsenv and the tab completion run these scripts all the time, so --help and
+--version must answer without loading boto3, gnupg, smtplib and friends, and
+within a budget of import time. Exits 1 when a script goes over it.
+
+Usage:
+    $ python benchmarks/startup.py
+    $ python benchmarks/startup.py --budget-ms 30 -o startup.json
+'''
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIN = os.path.join(ROOT, "bin")
+
+# none of these may be imported just to print the help
+HEAVY = ("boto3", "botocore", "gnupg", "smtplib", "email.mime", "sqlite3", "urllib3", "dateutil")
+
+COMMANDS = [
+    ("aws-env-update.py", ["--help"]),
+    ("aws-env-update.py", ["--version"]),
+    ("aws-list-ec2.py", ["--help"]),
+    ("aws-clean-eb-versions.py", ["--help"]),
+    ("aws-clean-eb-versions.py", ["--version"]),
+    ("aws-roll-keys.py", ["--help"]),
+    ("aws-roll-keys.py", ["--version"]),
+    ("aws-env-agent.py", ["--help"]),
+]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(__file__, description="Import time budget of the aws-tools scripts")
+    parser.add_argument("-b", "--budget-ms", type=float, default=50,
+                        help="Most import time a script may add to the bare interpreter to answer --help "
+                             "(default: 50)")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="Runs per command, the median counts (default: 5)")
+    parser.add_argument("-o", "--out", help="Where to save the JSON results")
+    return parser.parse_args()
+
+
+def import_times(cmd, env):
+    '''{module: self import time in us} of a command, and its wall time in ms'''
+    started = time.monotonic()
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + cmd, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = (time.monotonic() - started) * 1e3
+    times = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(self_us)
+    return times, wall
+
+
+def run(script, args, env, baseline):
+    '''Import time in ms of what the interpreter doesn't load anyway, imported modules and wall time in ms'''
+    times, wall = import_times([os.path.join(BIN, script)] + args, env)
+    own = sum(us for name, us in times.items() if name not in baseline)
+    return own / 1e3, set(times), wall
+
+
+def main():
+    args = get_args()
+    home = tempfile.mkdtemp(prefix="aws-tools-startup-")
+    os.makedirs(os.path.join(home, ".aws"))
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+
+    # modules every python process imports on its own, e.g. site and encodings
+    baseline = set(import_times(["-c", "pass"], env)[0])
+
+    results = []
+    over = False
+    for script, script_args in COMMANDS:
+        runs = [run(script, script_args, env, baseline) for _ in range(args.runs)]
+        heavy = sorted(name for name in set().union(*(modules for _, modules, _ in runs))
+                       if any(name == mod or name.startswith(mod + ".") for mod in HEAVY))
+        result = {
+            "command": [script] + script_args,
+            "import_ms": round(statistics.median(import_ms for import_ms, _, _ in runs), 1),
+            "wall_ms": round(statistics.median(wall for _, _, wall in runs), 1),
+            "heavy_imports": heavy,
+        }
+        failed = heavy or result["import_ms"] > args.budget_ms
+        over = over or failed
+        results.append(result)
+        print("{0:<40} import {1:>7.1f} ms  wall {2:>7.1f} ms  {3}".format(
+            " ".join(result["command"]), result["import_ms"], result["wall_ms"],
+            "heavy: " + ", ".join(heavy) if heavy else ("over budget" if failed else "ok")), file=sys.stderr)
+
+    shutil.rmtree(home, ignore_errors=True)
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump({"python": sys.version.split()[0], "budget_ms": args.budget_ms, "results": results}, out,
+                      indent=2)
+            out.write("\n")
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
@@ -1,93 +1,462 @@
 #!/usr/bin/env python3
 
 import argparse
+import datetime
+import json
+import os
+import re
 import sys
+import time
 import logging
-import boto3
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from aws_tools import clients, trace
+from aws_tools.crypto import CryptoSession, CryptoError
+from aws_tools.envs import get_available_envs
+from aws_tools.throttle import TokenBucket, call_with_retry
 
-client = boto3.client("elasticbeanstalk")
+home = os.environ["HOME"]
+aws_config_dir = "{}/.aws/".format(home)
+
+# S3 DeleteObjects takes at most this many keys per request
+DELETE_OBJECTS_BATCH = 1000
+
+# workers of every target print at once, one line at a time
+output_lock = threading.Lock()
 
 # Fix Python 2.x.
 try: input = raw_input
 except NameError: pass
 
-# get list of currently deployed versions for each app
-def get_deployed_versions():
+class Target(object):
+    '''One (account, region) to clean up, with its own clients'''
+
+    def __init__(self, env=None, region=None, credentials=None, concurrency=1, prefix=False):
+        # let the pool fit all the workers
+        options = dict(region=region, credentials=credentials, max_pool_connections=max(10, concurrency))
+        self.env = env
+        # listings are retried by botocore
+        self.eb = clients.client("elasticbeanstalk", retries={"mode": "standard"}, **options)
+        self.s3 = clients.client("s3", retries={"mode": "standard"}, **options)
+        # deletes are retried by counted_call within the rate limit, botocore mustn't retry them behind its back
+        once = {"mode": "standard", "total_max_attempts": 1}
+        self.eb_delete = clients.client("elasticbeanstalk", retries=once, **options)
+        self.s3_delete = clients.client("s3", retries=once, **options)
+        self.region = self.eb.meta.region_name
+        self.name = "{0}/{1}".format(env, self.region) if env else self.region
+        self.prefix = prefix
+
+    def say(self, msg):
+        # several targets print at once, tell them apart
+        line = "[{0}] {1}".format(self.name, msg) if self.prefix else msg
+        with output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+def get_env_credentials(envs, use_agent, gpg_binary):
+    '''Decrypt every env file once, return client credentials per env'''
+    crypto = CryptoSession(use_agent, gpg_binary)
+    paths = [os.path.join(os.sep, aws_config_dir, "env.{0}.conf.asc".format(env)) for env in envs]
+
+    # check the passphrase once on the first env, instead of failing on every file
+    try:
+        decrypted = {paths[0]: crypto.unlock(paths[0])}
+    except (CryptoError, IOError) as exc:
+        logging.error(exc)
+        sys.exit(1)
+    decrypted.update(crypto.decrypt_files(paths[1:], jobs=min(8, len(paths))))
+
     res = {}
-    environments = client.describe_environments()
-    for env in environments["Environments"]:
-        try:
-            if env["ApplicationName"] in res:
-                res[env["ApplicationName"]].append(env["VersionLabel"])
-            else:
-                res[env["ApplicationName"]] = [env["VersionLabel"]]
-        except KeyError:
-            pass
+    for env, file_path in zip(envs, paths):
+        if decrypted[file_path] is None:
+            logging.warning("Skipping env {}".format(env))
+            continue
+        res[env] = {
+            "aws_access_key_id": re.findall(r"aws_access_key_id = (.*)", decrypted[file_path])[0],
+            "aws_secret_access_key": re.findall(r"aws_secret_access_key = (.*)", decrypted[file_path])[0],
+        }
     return res
 
-# get list of app versions per app
-def get_versions_per_app():
+# get set of currently deployed versions for each app
+def get_deployed_versions(target):
     res = {}
-    versions = client.describe_application_versions()
-    # sort by date
-    versions = sorted(versions["ApplicationVersions"], key=lambda x: x["DateCreated"], reverse=True)
-    for v in versions:
-        try:
-            if v["ApplicationName"] in res:
-                res[v["ApplicationName"]].append( v["VersionLabel"] )
-            else:
-                res[v["ApplicationName"]] = [v["VersionLabel"]]
-        except KeyError:
-            pass
+    environments = target.eb.get_paginator("describe_environments").paginate()
+    for env in environments.search("Environments[]"):
+        if "VersionLabel" in env:
+            res.setdefault(env["ApplicationName"], set()).add(env["VersionLabel"])
     return res
 
-def get_deleted_versions(deployed_versions, app_versions, keep_versions):
-    res = app_versions[:]
-    res = list( set(res) - set(deployed_versions) )
-    return res[keep_versions - 1 :]
+def get_applications(target):
+    return sorted(app["ApplicationName"] for app in target.eb.describe_applications()["Applications"])
 
-def get_kept_versions(deployed_versions, app_versions, keep_versions):
-    res = app_versions[:]
-    res = res[0:keep_versions]
-    res = list( set(res) | set(deployed_versions) )
+# get list of versions of a single app, newest first
+def get_app_versions(target, app):
+    versions = target.eb.get_paginator("describe_application_versions").paginate(
+        ApplicationName=app, PaginationConfig={"PageSize": 1000})
+    return sorted(versions.search("ApplicationVersions[]"), key=lambda x: x["DateCreated"], reverse=True)
+
+# get lists of versions of all apps, newest first, with a single listing of the account
+def get_versions_per_app(target):
+    res = {}
+    versions = target.eb.get_paginator("describe_application_versions").paginate(
+        PaginationConfig={"PageSize": 1000})
+    for v in versions.search("ApplicationVersions[]"):
+        res.setdefault(v["ApplicationName"], []).append(v)
+    for app_versions in res.values():
+        app_versions.sort(key=lambda x: x["DateCreated"], reverse=True)
     return res
 
-def delete_version(version, app):
-    client.delete_application_version(
+def plan_versions(app_versions, deployed_versions, keep_versions):
+    '''Split newest first versions into the ones to keep and the ones to delete in a single pass'''
+    keep, delete = [], []
+    for n, version in enumerate(app_versions):
+        if n < keep_versions or version["VersionLabel"] in deployed_versions:
+            keep.append(version)
+        else:
+            delete.append(version)
+    return keep, delete
+
+def get_bundle_sizes(target, bundles):
+    '''Look up sizes of (bucket, key) pairs, listing every bucket prefix only once'''
+    from botocore.exceptions import ClientError
+
+    wanted = {}
+    for bucket, key in bundles:
+        prefix = key.split("/", 1)[0] + "/" if "/" in key else ""
+        wanted.setdefault((bucket, prefix), set()).add(key)
+
+    sizes = {}
+    for (bucket, prefix), keys in wanted.items():
+        try:
+            for page in target.s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    if obj["Key"] in keys:
+                        sizes[(bucket, obj["Key"])] = obj["Size"]
+        except ClientError as exc:
+            logging.warning("Can't list s3://%s/%s, bundle sizes will be missing: %s", bucket, prefix, exc)
+    return sizes
+
+def make_plan(target, keep_versions):
+    '''Compute the retention plan of every app, ready to be saved with write_plan'''
+    deployed_versions = get_deployed_versions(target)
+    versions_per_app = get_versions_per_app(target)
+
+    apps = []
+    for app in sorted(versions_per_app):
+        versions_to_keep, versions_to_delete = plan_versions(
+            versions_per_app[app], deployed_versions.get(app, set()), keep_versions)
+        apps.append({
+            "name": app,
+            "keep": [v["VersionLabel"] for v in versions_to_keep],
+            "delete": [{
+                "version": v["VersionLabel"],
+                "created": str(v["DateCreated"]),
+                "bucket": v.get("SourceBundle", {}).get("S3Bucket"),
+                "key": v.get("SourceBundle", {}).get("S3Key"),
+                "size": None,
+            } for v in versions_to_delete],
+        })
+
+    sizes = get_bundle_sizes(target, [(d["bucket"], d["key"]) for app in apps for d in app["delete"] if d["bucket"]])
+    for app in apps:
+        for d in app["delete"]:
+            d["size"] = sizes.get((d["bucket"], d["key"]))
+
+    return {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "env": target.env,
+        "region": target.region,
+        "keep_versions": keep_versions,
+        "applications": apps,
+    }
+
+def write_plan(plan, path):
+    with open(path, "w") as out:
+        json.dump(plan, out, indent=2)
+        out.write("\n")
+
+def read_plan(path):
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+def get_bundle(version):
+    bundle = version.get("SourceBundle")
+    if not bundle:
+        return None
+    return {"bucket": bundle["S3Bucket"], "key": bundle["S3Key"], "size": None}
+
+def get_plan_jobs(plan):
+    '''Yield (app, version, bundle) to delete from a saved plan, without listing anything'''
+    for app in plan["applications"]:
+        for d in app["delete"]:
+            bundle = {"bucket": d["bucket"], "key": d["key"], "size": d["size"]} if d["bucket"] else None
+            yield app["name"], d["version"], bundle
+
+def plan_bytes(plan):
+    return sum(d["size"] or 0 for app in plan["applications"] for d in app["delete"])
+
+def get_jobs(target, keep_versions, force):
+    '''Yield (app, version, bundle) to delete, listing one application at a time'''
+    deployed_versions = get_deployed_versions(target)
+
+    for app in get_applications(target):
+        versions_to_keep, versions_to_delete = plan_versions(
+            get_app_versions(target, app), deployed_versions.get(app, set()), keep_versions)
+        if len(versions_to_delete) == 0:
+            target.say("%s - Nothing to delete" % app)
+            continue
+        target.say("%s - %s versions will remain. %s versions will be deleted" % ( app, len(versions_to_keep), len(versions_to_delete) ) )
+        if force:
+            userInput = "y"
+        else:
+            # workers of the previous app wait with their output until it is answered
+            with output_lock:
+                sys.stdout.write("Are you sure you want to delete? (Y/N)\n")
+                userInput = input(':')
+        if userInput.lower() == "y":
+            for version in versions_to_delete:
+                yield app, version["VersionLabel"], get_bundle(version)
+
+def delete_version(target, version, app, delete_bundle=True):
+    target.eb_delete.delete_application_version(
         ApplicationName=app,
         VersionLabel=version,
-        DeleteSourceBundle=True
+        DeleteSourceBundle=delete_bundle
     )
 
+def counted_call(call, bucket, stats, lock, retries):
+    '''call_with_retry() which counts the calls and the retries in stats'''
+    def count(attempt):
+        with lock:
+            stats["calls"] += 1
+            if attempt:
+                stats["retried"] += 1
+
+    return call_with_retry(call, bucket, retries, count)
+
+def delete_with_retry(target, version, app, bundle, bucket, stats, lock, retries, bundles):
+    try:
+        counted_call(lambda: delete_version(target, version, app, bundles is None), bucket, stats, lock, retries)
+    except Exception as exc:
+        logging.error("%s: can't delete version %s of %s: %s", target.name, version, app, exc)
+        with lock:
+            stats["failed"] += 1
+        return
+    with lock:
+        stats["deleted"] += 1
+        # bundles of deleted versions only, the others are still in use
+        if bundles is not None and bundle:
+            bundles.append(bundle)
+    target.say("Deleted version %s of %s" % (version, app))
+
+def delete_bundle_batch(target, name, keys, bucket, stats, lock, retries):
+    try:
+        resp = counted_call(lambda: target.s3_delete.delete_objects(
+            Bucket=name, Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}),
+            bucket, stats, lock, retries)
+    except Exception as exc:
+        logging.error("Can't delete %d bundles from %s: %s", len(keys), name, exc)
+        with lock:
+            stats["bundles_failed"] += len(keys)
+        return set()
+    errors = resp.get("Errors", [])
+    for error in errors:
+        logging.error("Can't delete s3://%s/%s: %s", name, error["Key"], error.get("Message"))
+    with lock:
+        stats["bundles"] += len(keys) - len(errors)
+        stats["bundles_failed"] += len(errors)
+    return set(keys) - set(error["Key"] for error in errors)
+
+def delete_bundles(target, bundles, concurrency, bucket, stats, lock, retries):
+    '''Remove source bundles with S3 DeleteObjects, up to 1000 keys per request, several requests at once'''
+    sizes = {(b["bucket"], b["key"]): b["size"] for b in bundles}
+    # versions found by listing don't know their bundle sizes yet, objects are still there to be measured
+    missing = [key for key, size in sizes.items() if size is None]
+    if missing:
+        sizes.update(get_bundle_sizes(target, missing))
+
+    keys_per_bucket = {}
+    for name, key in sizes:
+        keys_per_bucket.setdefault(name, []).append(key)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {}
+        for name, keys in keys_per_bucket.items():
+            for n in range(0, len(keys), DELETE_OBJECTS_BATCH):
+                batch = keys[n:n + DELETE_OBJECTS_BATCH]
+                futures[pool.submit(delete_bundle_batch, target, name, batch, bucket, stats, lock, retries)] = name
+        for future, name in futures.items():
+            for key in future.result():
+                stats["bytes"] += sizes.get((name, key)) or 0
+
+def delete_versions(target, jobs, concurrency, rate, retries, batch_bundles=False):
+    '''Delete (app, version, bundle) on a worker pool as they come, return a summary of the run'''
+    stats = collections.Counter(deleted=0, failed=0, retried=0, calls=0)
+    lock = threading.Lock()
+    bucket = TokenBucket(rate)
+    bundles = [] if batch_bundles else None
+    started = time.monotonic()
+
+    # workers start on the first app while the next ones are still being listed, the listing
+    # waits when it gets a few jobs per worker ahead so the queue doesn't hold the whole account
+    slots = threading.BoundedSemaphore(concurrency * 4)
+
+    def work(version, app, bundle):
+        try:
+            delete_with_retry(target, version, app, bundle, bucket, stats, lock, retries, bundles)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for app, version, bundle in jobs:
+            slots.acquire()
+            pool.submit(work, version, app, bundle)
+
+    if bundles:
+        delete_bundles(target, bundles, concurrency, bucket, stats, lock, retries)
+
+    stats["elapsed"] = time.monotonic() - started
+    return stats
+
+def plan_path(out, target):
+    if not target.prefix:
+        return out
+    root, ext = os.path.splitext(out)
+    # without -e the targets are regions of the default credentials
+    parts = [root, target.env, target.region] if target.env else [root, target.region]
+    return "{0}{1}".format(".".join(parts), ext)
+
+def clean_target(target, args, plan=None):
+    '''Run the selected command against one target, return its summary'''
+    if args.command == "plan":
+        plan = make_plan(target, args.keep_versions)
+        path = plan_path(args.out, target)
+        write_plan(plan, path)
+        target.say("Plan saved to %s: %d applications, %d versions (%d bytes) to delete" % (
+            path, len(plan["applications"]), sum(len(app["delete"]) for app in plan["applications"]),
+            plan_bytes(plan)))
+        return None
+
+    if plan is not None:
+        jobs = list(get_plan_jobs(plan))
+    else:
+        jobs = get_jobs(target, args.keep_versions, args.force)
+    stats = delete_versions(target, jobs, args.concurrency, args.rate, args.retries, args.batch_bundles)
+    if stats["calls"]:
+        report(target.say, stats, args.batch_bundles)
+    return stats
+
+def report(say, stats, batch_bundles):
+    say("Deleted: %d, failed: %d, retried: %d, elapsed: %.1fs, %.1f calls/s" % (
+        stats["deleted"], stats["failed"], stats["retried"], stats["elapsed"],
+        stats["calls"] / stats["elapsed"] if stats["elapsed"] else 0))
+    if batch_bundles:
+        say("Bundles deleted: %d, failed: %d, reclaimed: %d bytes" % (
+            stats["bundles"], stats["bundles_failed"], stats["bytes"]))
+
 def main():
 
     parser = argparse.ArgumentParser(
         description="Delete old EB application versions",
         epilog="Copyright (C) 2017 Kamil Zegier <kamilzegier@gmail.com>")
+    parser.add_argument("command", nargs="?", choices=["plan", "apply"],
+                        help="plan: save the retention plan of every app without deleting anything, "
+                             "apply: delete versions listed in saved plans")
+    parser.add_argument("plan_files", nargs="*", help="Plans to apply")
+    parser.add_argument("-o", "--out", action="store", default="plan.json", help="Where to save the plan, with several targets <env>.<region>, or <region> without -e, is added before the extension (default: plan.json)")
     parser.add_argument("-k", "--keep-versions", action="store", default=10, type=int, help="How many versions should we keep for each environment")
     parser.add_argument("-f", "--force", action="store_true", help="Force delete, dont ask for each application")
+    parser.add_argument("-c", "--concurrency", action="store", default=1, type=int, help="How many versions are deleted at once")
+    parser.add_argument("-r", "--rate", action="store", default=10.0, type=float, help="Max delete calls per second")
+    parser.add_argument("--retries", action="store", default=5, type=int, help="How many times a throttled call is retried")
+    parser.add_argument("-b", "--batch-bundles", action="store_true", help="Keep S3 source bundles while deleting versions, then remove them with batched S3 DeleteObjects calls and report the bytes reclaimed")
+    parser.add_argument("-e", "--env", action="append", help="Clean up accounts of encrypted ~/.aws/env.<env>.conf.asc environments, can be given many times or 'all'")
+    parser.add_argument("--regions", action="store", help="Comma separated list of regions to clean up")
+    parser.add_argument("-t", "--targets", action="store", default=4, type=int, help="How many (account, region) targets are cleaned up at once")
+    parser.add_argument("-a", "--use-agent", action="store_true", help="Use GPG agent")
+    parser.add_argument("--gpg-binary", help="GPG binary to use")
+    parser.add_argument("--trace", metavar="FILE", help="Print the latency of every AWS and gpg call to stderr, with --trace=FILE also save the timeline to a .json (Chrome trace) or .jsonl file")
     parser.add_argument("-v", "--version", help="Print version", action="version", version="%(prog)s 1.0")
-    args = parser.parse_args()
+    args = parser.parse_args(trace.argv())
 
-    deployed_versions = get_deployed_versions()
-    app_versions = get_versions_per_app()
+    if args.trace is not None:
+        trace.enable(args.trace)
 
-    for app in app_versions:
-        versions_to_keep = get_kept_versions(deployed_versions[app], app_versions[app], args.keep_versions)
-        versions_to_delete = get_deleted_versions(deployed_versions[app], app_versions[app], args.keep_versions)
-        if len(versions_to_delete) == 0:
-            print("%s - Nothing to delete" % app)
-            continue
-        print("%s - %s versions will remain. %s versions will be deleted" % ( app, len(versions_to_keep), len(versions_to_delete) ) )
-        if args.force:
-            userInput = "y"
-        else:
+    if args.concurrency < 1 or args.rate <= 0 or args.retries < 0 or args.targets < 1:
+        parser.error("concurrency, rate and targets must be positive, retries can't be negative")
+
+    if args.command == "apply":
+        if not args.plan_files:
+            parser.error("apply needs a plan file")
+        plans = [read_plan(path) for path in args.plan_files]
+        pairs = [(plan.get("env"), plan["region"]) for plan in plans]
+    else:
+        if args.plan_files:
+            parser.error("plan files are only taken by apply")
+        plans = None
+        envs = [None]
+        if args.env:
+            available_envs = get_available_envs()
+            envs = available_envs if "all" in args.env else args.env
+            unknown = set(envs) - set(available_envs)
+            if unknown:
+                parser.error("unknown env(s): %s" % ", ".join(sorted(unknown)))
+        regions = [r.strip() for r in args.regions.split(",") if r.strip()] if args.regions else [None]
+        pairs = [(env, region) for env in envs for region in regions]
+
+    if len(pairs) > 1 and args.command is None and not args.force:
+        parser.error("several targets are cleaned up at once, use --force or plan/apply")
+
+    needed_envs = sorted(set(env for env, region in pairs if env))
+    credentials = get_env_credentials(needed_envs, args.use_agent, args.gpg_binary) if needed_envs else {}
+    targets = [Target(env, region, credentials.get(env), args.concurrency, len(pairs) > 1)
+               for env, region in pairs if env is None or env in credentials]
+    if plans is not None:
+        plans = [plan for plan in plans if plan.get("env") is None or plan.get("env") in credentials]
+
+    if args.command == "apply":
+        total = sum(len(app["delete"]) for plan in plans for app in plan["applications"])
+        print("%s versions (%d bytes) in %s targets will be deleted" % (
+            total, sum(plan_bytes(plan) for plan in plans), len(targets)))
+        if not args.force:
             print("Are you sure you want to delete? (Y/N)")
-            userInput = input(':')
-        if userInput.lower() == "y":
-            for version in versions_to_delete:
-                delete_version(version, app)
-                print ("Deleted version %s", (version) )
+            if input(':').lower() != "y":
+                return
+
+    if len(targets) == 1:
+        results = {targets[0].name: clean_target(targets[0], args, plans[0] if plans else None)}
+    else:
+        results = {}
+        with ThreadPoolExecutor(max_workers=args.targets) as pool:
+            futures = {pool.submit(clean_target, target, args, plans[n] if plans else None): target
+                       for n, target in enumerate(targets)}
+            for future in as_completed(futures):
+                target = futures[future]
+                try:
+                    results[target.name] = future.result()
+                except Exception as exc:
+                    logging.error("%s: cleanup failed: %s", target.name, exc)
+                    results[target.name] = collections.Counter(target_failed=1)
+
+    if args.command == "plan":
+        return
+
+    total = collections.Counter()
+    for name in sorted(results):
+        total.update(results[name])
+    if len(targets) > 1:
+        print("Combined report for %d targets:" % len(targets))
+        for name in sorted(results):
+            if results[name]["target_failed"]:
+                print("[%s] failed" % name)
+            else:
+                report(lambda msg: print("[%s] %s" % (name, msg)), results[name], args.batch_bundles)
+        # targets run side by side, the wall time is the longest of them
+        total["elapsed"] = max(stats["elapsed"] for stats in results.values())
+        report(lambda msg: print("[total] %s" % msg), total, args.batch_bundles)
+    if total["failed"] or total["bundles_failed"] or total["target_failed"]:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import logging as log
+import os
+import socket
+import struct
+import sys
+import time
+from aws_tools import trace
+from aws_tools.agent import request, socket_path as agent_socket
+
+
+PR_SET_DUMPABLE = 4
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.mlock.argtypes = libc.munlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+except (OSError, AttributeError):
+    libc = None
+
+
+class Secret(object):
+    '''Decrypted credentials kept in a buffer which is locked in RAM and wiped on expiry'''
+
+    def __init__(self, data, ttl):
+        self.size = max(1, len(data))
+        self.buf = ctypes.create_string_buffer(data, self.size)
+        self.expires = time.time() + ttl
+        self.locked = libc is not None and libc.mlock(ctypes.addressof(self.buf), self.size) == 0
+        if not self.locked:
+            log.warning('Unable to lock credentials in memory, they may be swapped out')
+
+    def value(self):
+        return self.buf.raw[:self.size].rstrip(b'\0')
+
+    def wipe(self):
+        ctypes.memset(self.buf, 0, self.size)
+        if self.locked:
+            libc.munlock(ctypes.addressof(self.buf), self.size)
+            self.locked = False
+
+
+def get_args():
+    '''This function parses and return arguments passed in'''
+    parser = argparse.ArgumentParser(__file__, formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=('''\
+Keeps credentials decrypted by aws-env-update.py in memory for a while,
+so switching between envs doesn't need gpg every time.
+Usage:\n\n\t$ aws-env-agent.py start \n'''),
+                                     epilog="Copyright (C) 2016 Bart Jakubowski <bartekj@gmail.com>")
+    parser.add_argument("command", choices=["start", "stop", "flush", "status"], help="What to do with the agent")
+    parser.add_argument("-t", "--ttl", type=int, default=3600, help="How long credentials are kept, in seconds (default: 3600)")
+    parser.add_argument("--foreground", action="store_true", help="Don't detach from the terminal")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Time every request, with --trace=FILE the timeline is saved to a .json (Chrome trace) "
+                             "or .jsonl file when the agent stops")
+    parser.add_argument("-d", "--debug", action='store_true', help="Debug mode")
+    parser.add_argument('-v', "--version", help="Print version", action='version', version='%(prog)s 1.0')
+    args = parser.parse_args(trace.argv())
+    if args.ttl < 1:
+        parser.error("--ttl must be at least 1 second")
+    return args
+
+
+def peer_uid(conn):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        # the socket file permissions are all we have
+        return os.getuid()
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def handle(msg, cache, ttl):
+    op = msg.get('op')
+    if op == 'get':
+        secret = cache.get(msg.get('key'))
+        if secret is None:
+            return {'ok': False}
+        # purge() runs only between requests, don't serve what expired since
+        if secret.expires <= time.time():
+            cache.pop(msg['key']).wipe()
+            return {'ok': False}
+        return {'ok': True, 'data': secret.value().decode('utf-8')}
+    if op == 'put':
+        old = cache.pop(msg['key'], None)
+        if old is not None:
+            old.wipe()
+        cache[msg['key']] = Secret(msg['data'].encode('utf-8'), ttl)
+        return {'ok': True}
+    if op in ('flush', 'stop'):
+        for secret in cache.values():
+            secret.wipe()
+        cache.clear()
+        return {'ok': True}
+    if op == 'status':
+        return {'ok': True, 'entries': len(cache), 'ttl': ttl, 'pid': os.getpid()}
+    return {'ok': False, 'error': 'unknown request'}
+
+
+def purge(cache):
+    now = time.time()
+    for key in [key for key, secret in cache.items() if secret.expires <= now]:
+        cache.pop(key).wipe()
+
+
+def serve(server, ttl):
+    cache = {}
+    server.settimeout(min(60, ttl))
+    while True:
+        purge(cache)
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        try:
+            conn.settimeout(2)
+            if peer_uid(conn) != os.getuid():
+                log.warning('Refused a connection from another user')
+                continue
+            msg = json.loads(conn.makefile('rb').readline().decode('utf-8'))
+            with trace.span('agent.{0}'.format(msg.get('op')), 'agent'):
+                response = handle(msg, cache, ttl)
+            conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+            if msg.get('op') == 'stop':
+                return
+        except (OSError, ValueError, KeyError) as exc:
+            log.debug('Bad request: {0}'.format(exc))
+        finally:
+            conn.close()
+
+
+def listen():
+    if os.path.exists(agent_socket):
+        if request({'op': 'status'}) is not None:
+            log.error('Agent is already running')
+            sys.exit(1)
+        os.unlink(agent_socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(agent_socket)
+    finally:
+        os.umask(umask)
+    os.chmod(agent_socket, 0o600)
+    server.listen(16)
+    return server
+
+
+def daemonize():
+    if os.fork() > 0:
+        return False
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    os.chdir('/')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    return True
+
+
+def main():
+    args = get_args()
+
+    if args.debug:
+        log.basicConfig(format="%(levelname)s: %(message)s", level=log.DEBUG)
+        log.info("Debug output.")
+    else:
+        log.basicConfig(format="%(levelname)s: %(message)s")
+
+    if args.command != 'start':
+        response = request({'op': args.command})
+        if response is None:
+            log.error('Agent is not running')
+            sys.exit(1)
+        if args.command == 'status':
+            print('Agent {0} keeps {1} env(s) for {2}s'.format(response['pid'], response['entries'], response['ttl']))
+        return
+
+    if args.trace:
+        # the daemon runs in /
+        args.trace = os.path.abspath(args.trace)
+
+    server = listen()
+    if not args.foreground and not daemonize():
+        print('Agent listening on {0}'.format(agent_socket))
+        return
+
+    # only the serving process records, the file is written when it stops
+    if args.trace is not None:
+        trace.enable(args.trace)
+
+    # keep the decrypted credentials out of core dumps and away from ptrace
+    if libc is not None and hasattr(libc, 'prctl'):
+        libc.prctl(PR_SET_DUMPABLE, 0, 0, 0, 0)
+    try:
+        serve(server, args.ttl)
+    finally:
+        server.close()
+        os.unlink(agent_socket)
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4 smarttab
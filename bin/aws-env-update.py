@@ -1,26 +1,35 @@
 #!/usr/bin/env python3
 
 import argparse
-import getpass
+import json
 import logging as log
 import os
 import re
 import sys
-import gnupg
+import time
+from aws_tools import agent, trace
+from aws_tools.crypto import CryptoSession, CryptoError
+from aws_tools.envs import env_file, get_available_envs, write_index
 
 
 debug = 0
 home = os.environ['HOME']
 aws_config_dir = '{}/.aws/'.format(home)
 credential_file = '{0}/credentials'.format(aws_config_dir)
-env_file = '{0}/.env'.format(aws_config_dir)
+profiles_file = '{0}/.profiles.json'.format(aws_config_dir)
+# temporary credentials are renewed this many seconds before they expire
+session_margin = 300
+
+CREDENTIALS_FILE_TPL = """
+[default]
+aws_access_key_id = {aws_access_key_id}
+aws_secret_access_key = {aws_secret_access_key}
+aws_session_token = {aws_session_token}
+"""
 
 def get_args():
     '''This function parses and return arguments passed in'''
-    available_envs = list(
-        map(lambda file: re.sub(r"env.(.*).conf.asc", r"\1", file),
-            filter(lambda file: file.startswith("env"),
-                   os.listdir(aws_config_dir))))
+    available_envs = get_available_envs()
 
     parser = argparse.ArgumentParser(__file__, formatter_class=argparse.RawDescriptionHelpFormatter,
                                     description=('''\
@@ -31,22 +40,181 @@ Usage:\n\n\t$ awsenv test \n'''),
     file_group = parser.add_mutually_exclusive_group(required=True)
     file_group.add_argument("-e", "--env", help="environment name (conflicts with --file)", choices=available_envs)
     file_group.add_argument("-f", "--file", help="get credentials from the specified file (conflicts with --env)")
+    file_group.add_argument("--flush", action="store_true", help="Wipe credentials cached by aws-env-agent.py")
+    file_group.add_argument("--all-profiles", action="store_true",
+                            help="Save every env as a [<env>] profile in the ${HOME}/.aws/credentials file")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="How many env files are decrypted at once with --all-profiles")
     parser.add_argument("-a", "--use-agent", action="store_true", help="Use GPG agent")
     parser.add_argument("-x", "--export", action="store_true", help="Print eval-friendly output")
     parser.add_argument("--gpg-binary", help="GPG binary to use")
+    parser.add_argument("-s", "--session", action="store_true",
+                        help="Use temporary STS credentials instead of the long-lived keys, cached until they expire")
+    parser.add_argument("--duration", type=int, help="Lifetime of the temporary credentials in seconds")
+    parser.add_argument("--role-arn", help="Assume this role instead of getting a session token (implies --session)")
+    parser.add_argument("--sts-endpoint", help="STS endpoint URL, e.g. a local stand-in for testing")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Print the latency of every gpg and AWS call to stderr, "
+                             "with --trace=FILE also save the timeline to a .json (Chrome trace) or .jsonl file")
     parser.add_argument("-d", "--debug", action='store_true', help="Debug mode")
     parser.add_argument('-v', "--version", help="Print version", action='version', version='%(prog)s 1.0')
-    args = parser.parse_args()
-    return args.env, args.file, args.use_agent, args.export, args.gpg_binary, args.debug
+    args = parser.parse_args(trace.argv())
+    if args.trace is not None:
+        trace.enable(args.trace)
+    if args.role_arn:
+        args.session = True
+    return args
+
+def agent_key(env, encrypted_credentials_file):
+    # a re-encrypted file (e.g. after aws-roll-keys.py) must not be served from the cache
+    return '{0}:{1}'.format(env, os.stat(encrypted_credentials_file).st_mtime_ns)
+
+def get_crypto(use_agent, gpg_binary):
+    return CryptoSession(use_agent, gpg_binary, prompt="Enter the passphrase to decrypt the env file: ")
+
+def decrypt(encrypted_credentials_file, use_agent, gpg_binary):
+    try:
+        return get_crypto(use_agent, gpg_binary).unlock(encrypted_credentials_file)
+    except CryptoError:
+        log.error('Decryption failed, please try again')
+        sys.exit(1)
+
+def get_credentials(env, encrypted_credentials_file, use_agent, gpg_binary):
+    '''Decrypted env file, served by aws-env-agent.py when it has it'''
+    output = None
+    if env:
+        cache_key = agent_key(env, encrypted_credentials_file)
+        response = agent.request({'op': 'get', 'key': cache_key})
+        if response and response.get('ok'):
+            log.info('Credentials for {0} served by aws-env-agent.py'.format(env))
+            output = response['data']
+
+    if output is None:
+        output = decrypt(encrypted_credentials_file, use_agent, gpg_binary)
+        if env:
+            agent.request({'op': 'put', 'key': cache_key, 'data': output})
+
+    return output
+
+def file_hash(path):
+    import hashlib
+
+    with open(path, 'rb') as stream:
+        return hashlib.sha256(stream.read()).hexdigest()
+
+def decrypt_all(envs, use_agent, gpg_binary, jobs):
+    '''Decrypt env files side by side, one gpg process each; None for the ones which fail'''
+    if not envs:
+        return {}
+    paths = {env: os.path.join(os.sep, aws_config_dir, 'env.{0}.conf.asc'.format(env)) for env in envs}
+    crypto = get_crypto(use_agent, gpg_binary)
+    # the passphrase is checked once, on the first file
+    try:
+        res = {envs[0]: crypto.unlock(paths[envs[0]])}
+    except CryptoError:
+        log.error('Decryption failed, please try again')
+        sys.exit(1)
+    decrypted = crypto.decrypt_files([paths[env] for env in envs[1:]], jobs)
+    res.update((env, decrypted[paths[env]]) for env in envs[1:])
+    return res
+
+def write_profiles(use_agent, gpg_binary, jobs):
+    '''Save all envs as named profiles, decrypting only the ones changed since the last run'''
+    # awsenv runs on every switch, only this path pays for these
+    import configparser
+    import tempfile
+
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(credential_file)
+    try:
+        with open(profiles_file, 'r') as profiles_in:
+            known = json.load(profiles_in)
+    except (IOError, ValueError):
+        known = {}
+
+    envs = get_available_envs()
+    hashes = {env: file_hash(os.path.join(os.sep, aws_config_dir, 'env.{0}.conf.asc'.format(env))) for env in envs}
+    changed = [env for env in envs if known.get(env) != hashes[env] or not config.has_section(env)]
+
+    for env, output in decrypt_all(changed, use_agent, gpg_binary, jobs).items():
+        id = re.findall(r"aws_access_key_id = (.*)", output or '')
+        key = re.findall(r"aws_secret_access_key = (.*)", output or '')
+        if not id or not key:
+            if output is not None:
+                log.error('No AWS credentials in the decrypted file of env {0}!'.format(env))
+            hashes.pop(env)
+            continue
+        if config.has_section(env):
+            config.remove_section(env)
+        config.add_section(env)
+        config.set(env, 'aws_access_key_id', id[0])
+        config.set(env, 'aws_secret_access_key', key[0])
+
+    # profiles of env files which are gone
+    for env in known:
+        if env not in envs and config.has_section(env):
+            config.remove_section(env)
 
-def get_passphrase(use_agent=False):
-    if use_agent:
+    # replace the file at once, nobody should ever see half of it
+    fd, tmp = tempfile.mkstemp(dir=aws_config_dir, prefix='.credentials.')
+    with os.fdopen(fd, 'w') as credential_out:
+        config.write(credential_out)
+    os.replace(tmp, credential_file)
+
+    with open(profiles_file, 'w') as profiles_out:
+        json.dump(hashes, profiles_out)
+
+    print('Saved {0} profiles to {1}: {2} decrypted, {3} unchanged'.format(
+        len(hashes), credential_file, len([env for env in changed if env in hashes]),
+        len(envs) - len(changed)))
+
+def session_file(env):
+    return '{0}/.session.{1}.json'.format(aws_config_dir, env)
+
+def session_source(encrypted_credentials_file, role_arn):
+    # temporary credentials of rolled keys or of another role are no good
+    return '{0}:{1}'.format(os.stat(encrypted_credentials_file).st_mtime_ns, role_arn or '')
+
+def load_session(env, source):
+    try:
+        with open(session_file(env), 'r') as session_in:
+            session = json.load(session_in)
+    except (IOError, ValueError):
         return None
+    if session.get('source') != source or session.get('expiration', 0) - session_margin <= time.time():
+        return None
+    return session
+
+def save_session(env, session):
+    fd = os.open(session_file(env), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as session_out:
+        json.dump(session, session_out)
+
+def get_session(id, key, env, role_arn=None, duration=None, endpoint=None):
+    '''Trade long-lived keys for temporary STS credentials'''
+    # only this path talks to AWS, don't make every switch pay for importing boto3
+    from aws_tools import clients
+
+    sts = clients.client('sts', credentials={'aws_access_key_id': id, 'aws_secret_access_key': key},
+                         endpoint_url=endpoint)
+    kwargs = {'DurationSeconds': duration} if duration else {}
+    if role_arn:
+        credentials = sts.assume_role(RoleArn=role_arn, RoleSessionName='awsenv-{0}'.format(env or 'file'),
+                                      **kwargs)['Credentials']
     else:
-        return getpass.getpass("Enter the passphrase to decrypt the env file: ")
+        credentials = sts.get_session_token(**kwargs)['Credentials']
+    log.info('Got temporary credentials valid until {0}'.format(credentials['Expiration']))
+    return {
+        'aws_access_key_id': credentials['AccessKeyId'],
+        'aws_secret_access_key': credentials['SecretAccessKey'],
+        'aws_session_token': credentials['SessionToken'],
+        'expiration': credentials['Expiration'].timestamp(),
+    }
 
 def main():
-    env, file_arg, use_agent, export, gpg_binary, debug = get_args()
+    args = get_args()
+    env, file_arg, flush, use_agent, export, gpg_binary, debug = (
+        args.env, args.file, args.flush, args.use_agent, args.export, args.gpg_binary, args.debug)
 
     if debug:
         log.basicConfig(format="%(levelname)s: %(message)s", level=log.DEBUG)
@@ -54,6 +222,16 @@ def main():
     else:
         log.basicConfig(format="%(levelname)s: %(message)s")
 
+    if flush:
+        if agent.request({'op': 'flush'}) is None:
+            log.error('aws-env-agent.py is not running')
+            sys.exit(1)
+        return
+
+    if args.all_profiles:
+        write_profiles(use_agent, gpg_binary, args.jobs)
+        return
+
     if env:
         encrypted_credentials_file = os.path.join(os.sep, aws_config_dir, 'env.{0}.conf.asc'.format(env))
     elif file_arg:
@@ -66,50 +244,52 @@ def main():
         log.error('''File with encrypted credentials for environment: {0} dont exists!.\n
                  Please encrypt your aws keys to file: \n{1}env.{0}.conf.asc'''.format(env, aws_config_dir))
 
-    if gpg_binary is not None:
-        gpg = gnupg.GPG(use_agent=use_agent, gpgbinary=gpg_binary)
-    else:
-        gpg = gnupg.GPG(use_agent=use_agent)
-
-    private_keys = gpg.list_keys(True)
-
-    if not private_keys:
-        log.error('No private key(s) found! Please check your GPG config')
-
-    stream = open(encrypted_credentials_file, "rb")
-    output = gpg.decrypt_file(stream, passphrase=get_passphrase(use_agent))
+    session = None
+    if args.session and env:
+        source = session_source(encrypted_credentials_file, args.role_arn)
+        session = load_session(env, source)
+        if session is not None:
+            log.info('Using cached temporary credentials for {0}'.format(env))
+            output = CREDENTIALS_FILE_TPL.format(**session)
 
-    if use_agent and output.status != 'decryption ok':
-        log.error('Decryption failed, please try again')
-        sys.exit(1)
-    else:
-        while output.status != 'decryption ok':
-            log.error('Decryption failed, check your password')
-            stream.seek(0)
-            output = gpg.decrypt_file(stream, passphrase=get_passphrase(use_agent))
+    if session is None:
+        output = get_credentials(env, encrypted_credentials_file, use_agent, gpg_binary)
 
     aws_credentials_patterns = ("aws_access_key_id", "aws_secret_access_key")
 
-    if any(x in str(output) for x in aws_credentials_patterns):
+    if session is None and args.session and all(x in output for x in aws_credentials_patterns):
+        session = get_session(
+            re.findall(r"{} = (.*)".format(aws_credentials_patterns[0]), output)[0],
+            re.findall(r"{} = (.*)".format(aws_credentials_patterns[1]), output)[0],
+            env, args.role_arn, args.duration, args.sts_endpoint)
+        output = CREDENTIALS_FILE_TPL.format(**session)
+        if env:
+            session['source'] = source
+            save_session(env, session)
+
+    if any(x in output for x in aws_credentials_patterns):
         if not export:
             with open(credential_file, 'w') as credential_out:
-                credential_out.write(str(output))
+                credential_out.write(output)
             if env:
                 with open(env_file, 'w') as env_out:
                     env_out.write(env)
+                write_index(get_available_envs(), env)
 
     else:
         log.error('No AWS credentials in the decrypted file!')
 
-    stream.close()
-
-    if export and output.status == "decryption ok":
-        id = re.findall(r"{} = (.*)".format(aws_credentials_patterns[0]), str(output))[0]
-        key = re.findall(r"{} = (.*)".format(aws_credentials_patterns[1]), str(output))[0]
+    if export:
+        id = re.findall(r"{} = (.*)".format(aws_credentials_patterns[0]), output)[0]
+        key = re.findall(r"{} = (.*)".format(aws_credentials_patterns[1]), output)[0]
 
         print("export AWS_ENV='{}'".format(env))
         print("export AWS_ACCESS_KEY_ID='{}'".format(id))
         print("export AWS_SECRET_ACCESS_KEY='{}'".format(key))
+        if session is not None:
+            print("export AWS_SESSION_TOKEN='{}'".format(session['aws_session_token']))
+        else:
+            print("unset AWS_SESSION_TOKEN")
 
 if __name__ == "__main__":
     main()
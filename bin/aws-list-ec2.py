@@ -1,123 +1,572 @@
 #!/usr/bin/env python3
 
+import os
+import csv
 import sys
+import time
 import getopt
-import boto3
 import json
+import fnmatch
 import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from aws_tools import clients, trace
+from aws_tools.throttle import is_throttled
 
 
-ec2 = boto3.resource('ec2')
-instances = ec2.instances.filter(InstanceIds=[])
+instance_ids = []
 ec2id = False
+regions = None
+workers = 8
+filters = []
+page_size = 1000
+use_cache = False
+refresh = False
+ttl = 300
+# every this many TTLs a refresh describes everything again, to catch changes which keep the state
+refill_ttls = 12
+output = 'table'
+trace_file = None
+watch_interval = None
+# every this many polls a watch describes everything again, to catch changes which keep the state
+resync_polls = 30
+# set when a region couldn't be listed, a partial listing must not pass for a complete one
+failed = False
+outputs = ('table', 'jsonl', 'csv', 'tsv')
+cache_file = os.path.join(os.environ['HOME'], '.aws', 'ec2-inventory.sqlite')
+# short names accepted by -f/--filter, anything else goes to the API as is
+filter_aliases = {
+    'state': 'instance-state-name',
+    'type': 'instance-type',
+    'vpc': 'vpc-id',
+    'subnet': 'subnet-id',
+    'ami': 'image-id',
+    'name': 'tag:Name',
+}
+# filters the cache knows how to apply locally, tag:<key> is handled separately
+local_filters = {
+    'instance-id': lambda i: i['InstanceId'],
+    'instance-state-name': lambda i: i['State']['Name'],
+    'instance-type': lambda i: i.get('InstanceType'),
+    'vpc-id': lambda i: i.get('VpcId'),
+    'subnet-id': lambda i: i.get('SubnetId'),
+    'image-id': lambda i: i.get('ImageId'),
+    'private-ip-address': lambda i: i.get('PrivateIpAddress'),
+    'ip-address': lambda i: i.get('PublicIpAddress'),
+}
 # https://pyformat.info/
-position = '{!s:<22} {!s:<12} {!s:<14} {!s:<18} {!s:<18} {!s:<22} {!s:<22} {!s:<30} {!s:<42}'
+position = '{!s:<22} {!s:<16} {!s:<12} {!s:<14} {!s:<18} {!s:<18} {!s:<22} {!s:<22} {!s:<30} {!s:<42}'
+columns = ['Instance Id', 'Region', 'State', 'Type', 'Private IP', 'Public IP', 'VPC Id', 'AMI Id',
+           'Launch Time', 'Name']
+detail_columns = ['Instance Id', 'Region', 'State', 'AMI Id', 'Type', 'Private IP', 'Public IP',
+                  'Availability zone', 'VPC Id', 'Subnet Id', 'Launch time', 'Virtualization',
+                  'Root device type', 'Root device name', 'EBS optimized', 'Key pair name', 'ARN profile',
+                  'Security groups', 'Tags']
 
 
 def usage():
-    print("Usage: {0} [-h|--help] [-i|--instance <instance_id>]".format(sys.argv[0]))
-
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'hi:', ['help', 'instance='])
-except getopt.GetoptError as msg:
-    print(msg)
-    usage()
-    sys.exit(1)
-
-for opt, arg in opts:
-    if opt in ('-h', '--help'):
-        print("List or describe EC2 instance details")
-        print("")
-        usage()
-        print("")
-        print("Options:")
-        print(" -h, --help                      Print this help screen")
-        print(" -i, --instance <instance_id>    Print instance details")
-        sys.exit(1)
-    elif opt in ('-i', '--instance'):
-        ec2id = True
-        instances = ec2.instances.filter(InstanceIds=[arg])
-    else:
+    print("Usage: {0} [-h|--help] [-i|--instance <instance_id>[,<instance_id>...]] [-o|--output <format>]"
+          " [-r|--regions all|<region>[,<region>...]]"
+          " [-w|--workers <n>] [-f|--filter <name>=<value>[,<value>...]] [-p|--page-size <n>]"
+          " [-c|--cached] [--refresh] [--ttl <seconds>] [--watch [<seconds>]] [--trace[=<file>]]".format(sys.argv[0]))
+
+def parse_filter(arg):
+    name, sep, values = arg.partition('=')
+    if not sep or not name or not values:
+        raise ValueError(arg)
+    return {'Name': filter_aliases.get(name, name), 'Values': values.split(',')}
+
+def parse_args():
+    global ec2id, regions, workers, page_size, use_cache, refresh, ttl, output, trace_file, watch_interval
+    # getopt has no optional arguments, --trace[=<file>] and --watch [<seconds>] are taken out beforehand
+    argv = []
+    rest = sys.argv[1:]
+    while rest:
+        arg = rest.pop(0)
+        if arg == '--trace' or arg.startswith('--trace='):
+            trace_file = arg.partition('=')[2]
+        elif arg == '--watch' or arg.startswith('--watch='):
+            value = arg.partition('=')[2]
+            if not value and rest and not rest[0].startswith('-'):
+                value = rest.pop(0)
+            try:
+                watch_interval = float(value or 2)
+            except ValueError:
+                watch_interval = 0
+            if watch_interval <= 0:
+                print("Watch interval must be a positive number of seconds: {0}".format(value))
+                usage()
+                sys.exit(1)
+        else:
+            argv.append(arg)
+
+    try:
+        opts, args = getopt.getopt(argv, 'hi:o:r:w:f:p:c',
+                                   ['help', 'instance=', 'output=', 'regions=', 'workers=', 'filter=', 'page-size=',
+                                    'cached', 'refresh', 'ttl='])
+    except getopt.GetoptError as msg:
+        print(msg)
         usage()
         sys.exit(1)
 
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            print("List or describe EC2 instance details")
+            print("")
+            usage()
+            print("")
+            print("Options:")
+            print(" -h, --help                      Print this help screen")
+            print(" -i, --instance <instance_ids>   Print instance details, comma separated or given many times")
+            print(" -o, --output <format>           One of: {0} (default: {1})".format(', '.join(outputs), output))
+            print(" -r, --regions <regions>         Comma separated list of regions to query")
+            print("                                 at the same time, or 'all' for every enabled region")
+            print(" -w, --workers <n>               How many regions are queried at once (default: {0})".format(workers))
+            print(" -f, --filter <name>=<values>    Server-side filter, e.g. state=running or tag:Name=api-*")
+            print("                                 can be given many times, values are comma separated")
+            print("                                 short names: {0}".format(', '.join(sorted(filter_aliases))))
+            print(" -p, --page-size <n>             Instances per DescribeInstances call, 5-1000 (default: {0})".format(page_size))
+            print(" -c, --cached                    Answer from the local inventory cache while it is fresh")
+            print("     --refresh                   Refresh the cache now, only instances whose state changed")
+            print("                                 are described again (implies --cached)")
+            print("     --ttl <seconds>             How long the cache stays fresh (default: {0}), every {1}".format(ttl, refill_ttls))
+            print("                                 TTLs a refresh describes all instances again")
+            print("     --watch [<seconds>]         Poll every few seconds (default: 2) and print only added (+),")
+            print("                                 removed (-) and changed (~) instances")
+            print("     --trace[=<file>]            Print the latency of every AWS call to stderr, and save")
+            print("                                 the timeline to a .json (Chrome trace) or .jsonl file")
+            sys.exit(1)
+        elif opt in ('-i', '--instance'):
+            ec2id = True
+            for instance_id in arg.split(','):
+                if instance_id and instance_id not in instance_ids:
+                    instance_ids.append(instance_id)
+        elif opt in ('-o', '--output'):
+            if arg not in outputs:
+                print("Output format must be one of: {0}".format(', '.join(outputs)))
+                usage()
+                sys.exit(1)
+            output = arg
+        elif opt in ('-r', '--regions'):
+            regions = arg
+        elif opt in ('-w', '--workers'):
+            try:
+                workers = int(arg)
+            except ValueError:
+                print("Number of workers must be an integer: {0}".format(arg))
+                usage()
+                sys.exit(1)
+        elif opt in ('-f', '--filter'):
+            try:
+                filters.append(parse_filter(arg))
+            except ValueError:
+                print("Filter must look like <name>=<value>[,<value>...]: {0}".format(arg))
+                usage()
+                sys.exit(1)
+        elif opt in ('-p', '--page-size'):
+            try:
+                page_size = int(arg)
+            except ValueError:
+                page_size = 0
+            if not 5 <= page_size <= 1000:
+                print("Page size must be an integer between 5 and 1000: {0}".format(arg))
+                usage()
+                sys.exit(1)
+        elif opt in ('-c', '--cached'):
+            use_cache = True
+        elif opt == '--refresh':
+            use_cache = True
+            refresh = True
+        elif opt == '--ttl':
+            try:
+                ttl = int(arg)
+            except ValueError:
+                print("TTL must be an integer: {0}".format(arg))
+                usage()
+                sys.exit(1)
+        else:
+            usage()
+            sys.exit(1)
+
+    if trace_file is not None:
+        trace.enable(trace_file)
+
 def legend():
-    if not ec2id:
-        print('-' * 200)
-        print(position.format(
-            'Instance Id',
-            'State',
-            'Type',
-            'Private IP',
-            'Public IP',
-            'VPC Id',
-            'AMI Id',
-            'Launch Time',
-            'Name'
-        ))
-        print('-' * 200)
-
-def get_ec2():
-    for instance in instances:
+    if not ec2id and output == 'table':
+        width = 225 if watch_interval else 217
+        print('-' * width)
+        print(row_format().format(*header()))
+        print('-' * width)
+
+def header():
+    cols = detail_columns if ec2id else columns
+    return ['Change'] + cols if watch_interval else cols
+
+def row_format():
+    return '{!s:<7} ' + position if watch_interval else position
+
+def flatten(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+def get_writer():
+    """Return a function writing one record to stdout in the selected output format."""
+    if output == 'jsonl':
+        def write(record):
+            sys.stdout.write(json.dumps(record, default=str, separators=(',', ':')) + '\n')
+    elif output in ('csv', 'tsv'):
+        out = csv.writer(sys.stdout, delimiter=',' if output == 'csv' else '\t', lineterminator='\n')
+        out.writerow(header())
+
+        def write(record):
+            out.writerow([flatten(value) for value in record.values()])
+    elif ec2id:
+        def write(record):
+            print(json.dumps(record, indent=2, default=str))
+    else:
+        fmt = row_format()
+
+        def write(record):
+            print(fmt.format(*record.values()))
+    return write
+
+def get_regions(arg):
+    if arg == 'all':
+        client = clients.client('ec2')
+        return sorted(region['RegionName'] for region in client.describe_regions()['Regions'])
+    return [region.strip() for region in arg.split(',') if region.strip()]
+
+def describe_instances(client, ids, server_filters):
+    """Yield raw instance dicts page by page, filtered on the server side."""
+    paginator = client.get_paginator('describe_instances')
+    if not ids:
+        pages = paginator.paginate(Filters=server_filters, PaginationConfig={'PageSize': page_size})
+        for instance in pages.search('Reservations[].Instances[]'):
+            yield instance
+        return
+    # ask for the ids in batches through a filter, unlike InstanceIds it doesn't
+    # fail on ids from other regions and it can be paged
+    for n in range(0, len(ids), 200):
+        id_filter = {'Name': 'instance-id', 'Values': ids[n:n + 200]}
+        pages = paginator.paginate(Filters=server_filters + [id_filter], PaginationConfig={'PageSize': page_size})
+        for instance in pages.search('Reservations[].Instances[]'):
+            yield instance
+
+def open_cache():
+    import sqlite3
+
+    # the inventory is nobody else's business, create it private
+    os.close(os.open(cache_file, os.O_CREAT | os.O_RDWR, 0o600))
+    conn = sqlite3.connect(cache_file, timeout=30)
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS accounts (
+            access_key TEXT PRIMARY KEY,
+            account TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS regions (
+            account TEXT NOT NULL,
+            region TEXT NOT NULL,
+            updated REAL NOT NULL,
+            filled REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (account, region));
+        CREATE TABLE IF NOT EXISTS instances (
+            account TEXT NOT NULL,
+            region TEXT NOT NULL,
+            instance_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (account, region, instance_id));
+    ''')
+    # caches made before regions had a filled column are refilled on their next refresh
+    if 'filled' not in [column[1] for column in conn.execute('PRAGMA table_info(regions)')]:
+        with conn:
+            conn.execute('ALTER TABLE regions ADD COLUMN filled REAL NOT NULL DEFAULT 0')
+    return conn
+
+def get_account(conn):
+    credentials = clients.get_credentials()
+    if credentials is None:
+        # let STS complain about missing credentials
+        return clients.client('sts').get_caller_identity()['Account']
+    row = conn.execute('SELECT account FROM accounts WHERE access_key = ?',
+                       (credentials.access_key,)).fetchone()
+    if row is not None:
+        return row[0]
+    account = clients.client('sts').get_caller_identity()['Account']
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?)', (credentials.access_key, account))
+    return account
+
+def store_instances(conn, account, region, instances):
+    conn.executemany('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?)', [
+        (account, region, i['InstanceId'], i['State']['Name'], json.dumps(i, default=str))
+        for i in instances])
+
+def fill_cache(conn, client, account, region):
+    updated = time.time()
+    instances = list(describe_instances(client, [], []))
+    with conn:
+        conn.execute('DELETE FROM instances WHERE account = ? AND region = ?', (account, region))
+        store_instances(conn, account, region, instances)
+        conn.execute('INSERT OR REPLACE INTO regions VALUES (?, ?, ?, ?)', (account, region, updated, updated))
+
+def refresh_cache(conn, client, account, region):
+    """Describe again only the instances which appeared or changed state since the last refresh."""
+    updated = time.time()
+    cached = dict(conn.execute('SELECT instance_id, state FROM instances WHERE account = ? AND region = ?',
+                               (account, region)))
+    pages = client.get_paginator('describe_instance_status').paginate(
+        IncludeAllInstances=True, PaginationConfig={'PageSize': 1000})
+    current = {i['InstanceId']: i['InstanceState']['Name'] for i in pages.search('InstanceStatuses[]')}
 
-        if ec2id:
-            sg = {i['GroupId']: i['GroupName'] for i in instance.security_groups}
-            tag = {i['Key']: i['Value'] for i in instance.tags or []}
-
-            ec2info = collections.OrderedDict([
-                ('Instance Id', instance.id),
-                ('State', instance.state['Name']),
-                ('AMI Id', instance.image_id),
-                ('Type', instance.instance_type),
-                ('Private IP', instance.private_ip_address),
-                ('Public IP', instance.public_ip_address),
-                ('Availability zone', instance.placement['AvailabilityZone']),
-                ('VPC Id', instance.vpc_id),
-                ('Subnet Id', instance.subnet_id),
-                ('Launch time', str(instance.launch_time)),
-                ('Virtualization', instance.virtualization_type),
-                ('Root device type', instance.root_device_type),
-                ('Root device name', instance.root_device_name),
-                ('EBS optimized', instance.ebs_optimized),
-                ('Key pair name', instance.key_name),
-                ('ARN profile', instance.iam_instance_profile),
-                ('Security groups', sg),
-                ('Tags', tag)
-            ])
-
-            print(json.dumps(ec2info, indent=2))
+    changed = [i for i, state in current.items() if cached.get(i) != state]
+    gone = [i for i in cached if i not in current]
+    instances = []
+    if changed:
+        instances = list(describe_instances(client, changed, []))
 
+    with conn:
+        conn.executemany('DELETE FROM instances WHERE account = ? AND region = ? AND instance_id = ?',
+                         [(account, region, i) for i in gone])
+        store_instances(conn, account, region, instances)
+        conn.execute('UPDATE regions SET updated = ? WHERE account = ? AND region = ?', (updated, account, region))
+
+def cache_usable():
+    return all(f['Name'] in local_filters or f['Name'].startswith('tag:') for f in filters)
+
+def match_filters(instance):
+    for f in filters:
+        if f['Name'].startswith('tag:'):
+            key = f['Name'][len('tag:'):]
+            values = [t['Value'] for t in instance.get('Tags') or [] if t['Key'] == key]
         else:
-            ec2info = [
-                instance.id,
-                instance.state['Name'],
-                instance.instance_type,
-                instance.private_ip_address,
-                instance.public_ip_address,
-                instance.vpc_id,
-                instance.image_id,
-                str(instance.launch_time)
-            ]
-
-            keyfound = False
-
-            if instance.tags is not None:
-                for tag in instance.tags:
-                    if tag['Key'] == 'Name':
-                        ec2info.append(tag['Value'])
-                        keyfound = True
-                        break
-                if not keyfound:
-                    ec2info.append('')
+            values = [local_filters[f['Name']](instance)]
+        if not any(fnmatch.fnmatchcase(str(value), pattern) for value in values for pattern in f['Values']):
+            return False
+    return True
+
+def get_cached_instances(client, region):
+    """Return instances from the local inventory, or None when the cache can't answer."""
+    conn = open_cache()
+    try:
+        account = get_account(conn)
+        row = conn.execute('SELECT updated, filled FROM regions WHERE account = ? AND region = ?',
+                           (account, region)).fetchone()
+        if row is None:
+            fill_cache(conn, client, account, region)
+        elif refresh or time.time() - row[0] > ttl:
+            # tag, type or security group changes don't show in the states, every now and then describe it all
+            if time.time() - row[1] > ttl * refill_ttls:
+                fill_cache(conn, client, account, region)
             else:
-                ec2info.append('')
+                refresh_cache(conn, client, account, region)
+
+        rows = conn.execute('SELECT instance_id, data FROM instances WHERE account = ? AND region = ? '
+                            'ORDER BY instance_id', (account, region))
+        wanted = set(instance_ids)
+        instances = [json.loads(data) for instance_id, data in rows if not wanted or instance_id in wanted]
+    finally:
+        conn.close()
+
+    if instance_ids and len(instances) < len(instance_ids):
+        return None
+    return [i for i in instances if match_filters(i)]
+
+def get_name(instance):
+    for tag in instance.get('Tags') or []:
+        if tag['Key'] == 'Name':
+            return tag['Value']
+    return ''
+
+def make_record(instance, region):
+    if ec2id:
+        sg = {i['GroupId']: i['GroupName'] for i in instance.get('SecurityGroups', [])}
+        tag = {i['Key']: i['Value'] for i in instance.get('Tags') or []}
+
+        return collections.OrderedDict(zip(detail_columns, [
+            instance['InstanceId'],
+            region,
+            instance['State']['Name'],
+            instance.get('ImageId'),
+            instance.get('InstanceType'),
+            instance.get('PrivateIpAddress'),
+            instance.get('PublicIpAddress'),
+            instance['Placement']['AvailabilityZone'],
+            instance.get('VpcId'),
+            instance.get('SubnetId'),
+            str(instance.get('LaunchTime')),
+            instance.get('VirtualizationType'),
+            instance.get('RootDeviceType'),
+            instance.get('RootDeviceName'),
+            instance.get('EbsOptimized'),
+            instance.get('KeyName'),
+            instance.get('IamInstanceProfile'),
+            sg,
+            tag
+        ]))
+    else:
+        return collections.OrderedDict(zip(columns, [
+            instance['InstanceId'],
+            region,
+            instance['State']['Name'],
+            instance.get('InstanceType'),
+            instance.get('PrivateIpAddress'),
+            instance.get('PublicIpAddress'),
+            instance.get('VpcId'),
+            instance.get('ImageId'),
+            str(instance.get('LaunchTime')),
+            get_name(instance)
+        ]))
+
+def get_ec2(region=None):
+    client = clients.client('ec2', region)
+    region = client.meta.region_name
+
+    instances = None
+    if use_cache and cache_usable():
+        instances = get_cached_instances(client, region)
+    if instances is None:
+        instances = describe_instances(client, instance_ids, filters)
+
+    for instance in instances:
+        yield make_record(instance, region)
 
-            print(position.format(*ec2info))
+def get_region_ec2(region):
+    return list(get_ec2(region))
+
+def get_states(client):
+    """Return {instance id: state name} of every instance, one cheap listing per poll."""
+    # describe_instance_status knows only a few of the filters, the rest are applied when describing
+    status_filters = [f for f in filters if f['Name'] in ('instance-state-name', 'availability-zone')]
+    pages = client.get_paginator('describe_instance_status').paginate(
+        IncludeAllInstances=True, Filters=status_filters, PaginationConfig={'PageSize': page_size})
+    wanted = set(instance_ids)
+    return {status['InstanceId']: status['InstanceState']['Name']
+            for status in pages.search('InstanceStatuses[]')
+            if not wanted or status['InstanceId'] in wanted}
+
+def poll_region(region, index, full):
+    """Compare a region with its index {instance id: (state, record)}, return [(change, record)]."""
+    client = clients.client('ec2', region)
+    region = client.meta.region_name
+
+    if full:
+        described = {i['InstanceId']: i for i in describe_instances(client, instance_ids, filters)}
+        states = {instance_id: i['State']['Name'] for instance_id, i in described.items()}
+        stale = set(states)
+    else:
+        states = get_states(client)
+        # only instances which are new or changed state are described again
+        stale = set(instance_id for instance_id, state in states.items()
+                    if instance_id not in index or index[instance_id][0] != state)
+        described = {i['InstanceId']: i for i in describe_instances(client, list(stale), filters)} if stale else {}
+
+    changes = []
+    updated = {}
+    for instance_id, state in states.items():
+        old = index.get(instance_id, (None, None))[1]
+        if instance_id not in described:
+            # described but left out by the server side filters now
+            if instance_id in stale and old is not None:
+                changes.append(('-', old))
+                old = None
+            updated[instance_id] = (state, old)
+            continue
+        record = make_record(described[instance_id], region)
+        updated[instance_id] = (state, record)
+        if old is None:
+            changes.append(('+', record))
+        elif record != old:
+            changes.append(('~', record))
+    for instance_id, (state, old) in index.items():
+        if instance_id not in states and old is not None:
+            changes.append(('-', old))
+
+    index.clear()
+    index.update(updated)
+    return changes
+
+def watch(interval):
+    """Poll until interrupted, printing only the instances which changed."""
+    global failed
+    write = get_writer()
+    region_list = get_regions(regions) if regions else [None]
+    indexes = {region: {} for region in region_list}
+    delay = interval
+    polls = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(region_list)))) as pool:
+        while True:
+            full = polls % resync_polls == 0
+            throttled = False
+            futures = {pool.submit(poll_region, region, indexes[region], full): region for region in region_list}
+            for future in as_completed(futures):
+                try:
+                    changes = future.result()
+                except Exception as exc:
+                    if is_throttled(exc):
+                        throttled = True
+                    else:
+                        failed = True
+                        sys.stderr.write("Can't list instances in {0}: {1}\n".format(futures[future], exc))
+                    continue
+                for change, record in changes:
+                    write(collections.OrderedDict([('Change', change)] + list(record.items())))
+            sys.stdout.flush()
+            polls += 1
+
+            # back off while AWS throttles, then come back to the interval step by step
+            if throttled:
+                delay = min(delay * 2, max(60, interval * 16))
+                sys.stderr.write("Throttled, polling every {0:.0f}s\n".format(delay))
+            else:
+                delay = max(interval, delay / 2)
+            time.sleep(delay)
 
 def main():
+    global failed
+    parse_args()
     legend()
-    get_ec2()
+    if watch_interval:
+        try:
+            watch(watch_interval)
+        except KeyboardInterrupt:
+            pass
+        if failed:
+            sys.exit(1)
+        return
+    write = get_writer()
+    found = set()
+    if regions is None:
+        for record in get_ec2():
+            found.add(record['Instance Id'])
+            write(record)
+    else:
+        region_list = get_regions(regions)
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(region_list)))) as pool:
+            futures = {pool.submit(get_region_ec2, region): region for region in region_list}
+            # print every region as soon as it is done, slowest one goes last
+            for future in as_completed(futures):
+                try:
+                    records = future.result()
+                except Exception as exc:
+                    failed = True
+                    sys.stderr.write("Can't list instances in {0}: {1}\n".format(futures[future], exc))
+                    continue
+                for record in records:
+                    found.add(record['Instance Id'])
+                    write(record)
+                sys.stdout.flush()
     legend()
+    # the instance-id filter doesn't complain about unknown ids like InstanceIds did,
+    # with other filters given an id may be left out on purpose
+    missing = [instance_id for instance_id in instance_ids if instance_id not in found]
+    if missing and not filters:
+        sys.stderr.write("Instance(s) not found: {0}\n".format(', '.join(missing)))
+        failed = True
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
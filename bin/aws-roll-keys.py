@@ -1,19 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import os
 import re
 import sys
-import gnupg
+import time
 import logging
-import getpass
-import boto3
-import smtplib
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from aws_tools import clients, trace
+from aws_tools.crypto import CryptoSession, CryptoError
+from aws_tools.envs import get_available_envs
+from aws_tools.throttle import TokenBucket, backoff, call_with_retry
 
 
 KEY_ID = "aws_access_key_id"
@@ -27,84 +27,387 @@ aws_secret_access_key = {key}
 
 home = os.environ["HOME"]
 aws_config_dir = "{}/.aws/".format(home)
+users_dir = "{0}/users".format(aws_config_dir)
+ledger_file = "{0}/.rotations.json".format(aws_config_dir)
+outbox_dir = "{0}/outbox".format(aws_config_dir)
+smtp_conf_file = "{0}/smtp.cfg.asc".format(aws_config_dir)
 
 today = datetime.date.today()
 future = today + datetime.timedelta(days=7)
 
-def get_current_key(env, file_path, gpg, phrase):
-    private_keys = gpg.list_keys(True)
+class NotDue(Exception):
+    '''The key of an env is too young to be rotated'''
+
+    def __init__(self, create_date):
+        super(NotDue, self).__init__("key created {0}".format(create_date))
+        self.create_date = create_date
+
+class AdminKeyDue(Exception):
+    '''The key of the admin env is due with --users, it is rotated after all the others'''
+
+def read_ledger():
+    '''Last rotation of every env: {env: {"created": unix time, "mtime_ns": env file mtime}}'''
+    try:
+        with open(ledger_file, "r") as ledger_in:
+            return json.load(ledger_in)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def write_ledger(ledger):
+    # in place, for the same reason as the index
+    try:
+        with open(ledger_file, "w") as ledger_out:
+            json.dump(ledger, ledger_out, indent=1, sort_keys=True)
+    except (IOError, OSError) as exc:
+        logging.warning("Unable to write {0}: {1}".format(ledger_file, exc))
+
+def record(ledger, env, create_date):
+    file_path = os.path.join(os.sep, aws_config_dir, "env.{0}.conf.asc".format(env))
+    ledger[env] = {"created": create_date.timestamp(), "mtime_ns": os.stat(file_path).st_mtime_ns}
+
+def ledger_created(ledger, env):
+    '''When the key of an env was created, as long as the env file wasn't changed since'''
+    entry = ledger.get(env)
+    file_path = os.path.join(os.sep, aws_config_dir, "env.{0}.conf.asc".format(env))
+    try:
+        if entry is None or entry["mtime_ns"] != os.stat(file_path).st_mtime_ns:
+            return None
+        return datetime.datetime.fromtimestamp(entry["created"], datetime.timezone.utc)
+    except (OSError, KeyError, TypeError, ValueError):
+        return None
+
+def is_due(create_date, min_age, max_age):
+    '''Keys younger than min_age are never rotated, older than max_age always'''
+    age = datetime.datetime.now(datetime.timezone.utc) - create_date
+    if min_age is not None and age < min_age:
+        return False
+    return max_age is None or age > max_age
+
+def get_current_key(env, file_path, crypto, decrypted=None):
     id, key = (None, None)
-    if not private_keys:
-        logging.error("No private key(s) found! Please check your GPG config")
-        return (None, None)
     try:
-        with open(file_path, 'rb') as file:
-            decrypted = gpg.decrypt_file(file, passphrase=phrase)
-            if decrypted.status != "decryption ok":
-                logging.error("Unable to decrypt {}".format(file_path))
-                return (None, None)
-
-            id = re.findall(r"{} = (.*)".format(KEY_ID), str(decrypted))[0]
-            key = re.findall(r"{} = (.*)".format(ACCESS_KEY), str(decrypted))[0]
+        if decrypted is None:
+            decrypted = crypto.decrypt_file(file_path)
+
+        id = re.findall(r"{} = (.*)".format(KEY_ID), decrypted)[0]
+        key = re.findall(r"{} = (.*)".format(ACCESS_KEY), decrypted)[0]
+    except CryptoError as exc:
+        logging.error(exc)
     except IOError:
         logging.warning("File for env {} not found. Skipping.".format(env))
 
     return (id, key)
 
-def get_passphrase(use_agent=False):
-    if use_agent:
-        return None
-    else:
-        return getpass.getpass("Please enter passphrase for decrypting env files: ")
-
-def get_smtp_conf(smtpconf, gpg, phrase):
-    private_keys = gpg.list_keys(True)
+def get_smtp_conf(smtpconf, crypto):
     login, password, host, port, = (None, None, None, None)
-    if not private_keys:
-        logging.error("No private key(s) found! Please check your GPG config")
-        return (None, None, None, None)
     try:
-        with open(smtpconf, 'rb') as file:
-            decrypted = gpg.decrypt_file(file, passphrase=phrase)
-            if decrypted.status != "decryption ok":
-                logging.error("Unable to decrypt {}".format(smtpconf))
-                return (None, None, None, None)
-
-            login = re.findall(r"{} = (.*)".format("smtplogin"), str(decrypted))[0]
-            password = re.findall(r"{} = (.*)".format("smtppass"), str(decrypted))[0]
-            host = re.findall(r"{} = (.*)".format("smtphost"), str(decrypted))[0]
-            port = re.findall(r"{} = (.*)".format("smtpport"), str(decrypted))[0]
+        decrypted = crypto.decrypt_file(smtpconf) if crypto.unlocked else crypto.unlock(smtpconf)
+
+        login = re.findall(r"{} = (.*)".format("smtplogin"), decrypted)[0]
+        password = re.findall(r"{} = (.*)".format("smtppass"), decrypted)[0]
+        host = re.findall(r"{} = (.*)".format("smtphost"), decrypted)[0]
+        port = re.findall(r"{} = (.*)".format("smtpport"), decrypted)[0]
+    except CryptoError as exc:
+        logging.error(exc)
+        return (None, None, None, None)
     except IOError:
+        # the messages stay in the outbox until it can be read
         logging.error("Can't open {0}".format(smtpconf))
-        sys.exit(1)
+        return (None, None, None, None)
 
     return (login, password, host, port)
 
-def send(srv, sendto, data):
-    sendto_list = re.split(r',\s*', sendto)
-    try:
-        server = smtplib.SMTP(srv[2], srv[3])
-        server.set_debuglevel(False)
+def spool(msg, sendto):
+    '''Queue a message in the outbox, it is sent by flush_outbox() which sets its sender'''
+    if not os.path.isdir(outbox_dir):
+        os.makedirs(outbox_dir, 0o700)
+    path = os.path.join(outbox_dir, "{0:.6f}.{1}.json".format(time.time(), os.getpid()))
+    write_secret(path, json.dumps({"to": re.split(r',\s*', sendto), "subject": msg["Subject"],
+                                   "data": msg.as_string()}))
+    return path
+
+def smtp_connect(srv):
+    import smtplib
+
+    server = smtplib.SMTP(srv[2], srv[3], timeout=30)
+    server.set_debuglevel(False)
+    server.ehlo()
+    if server.has_extn('STARTTLS'):
+        server.starttls()
         server.ehlo()
-        if server.has_extn('STARTTLS'):
-            server.starttls()
-            server.ehlo()
+    # local relays and test servers don't ask for a login
+    if server.has_extn('AUTH'):
         server.login(srv[0], srv[1])
-        server.sendmail(srv[0], sendto_list, data)
-        server.quit()
+    return server
+
+def outbox():
+    try:
+        return sorted(os.path.join(outbox_dir, name) for name in os.listdir(outbox_dir) if name.endswith(".json"))
+    except OSError:
+        return []
+
+def flush_outbox(srv, retries=3):
+    '''Send every queued message over one SMTP session, return the ones left in the outbox'''
+    import smtplib
+    from email import message_from_string
+
+    server = None
+    left = []
+    paths = outbox()
+    for index, path in enumerate(paths):
+        with open(path, "r") as msg_in:
+            msg = json.load(msg_in)
+        data = message_from_string(msg["data"])
+        del data["From"]
+        data["From"] = srv[0]
+        for attempt in range(retries + 1):
+            try:
+                if server is None:
+                    with trace.span("smtp.connect", "smtp"):
+                        server = smtp_connect(srv)
+                with trace.span("smtp.send", "smtp"):
+                    server.sendmail(srv[0], msg["to"], data.as_string())
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as exc:
+                # the server is fine, it just doesn't want this message
+                logging.warning("Can't send '{0}': {1}".format(msg["subject"], exc))
+                left.append(path)
+                break
+            except (smtplib.SMTPException, OSError) as exc:
+                logging.warning("Can't send '{0}': {1}".format(msg["subject"], exc))
+                if server is not None:
+                    server.close()
+                    server = None
+                if attempt < retries:
+                    backoff(attempt)
+                continue
+            os.unlink(path)
+            print("Sent '{0}' to: {1}".format(msg["subject"], ", ".join(msg["to"])))
+            break
+        else:
+            left.append(path)
+            if server is None:
+                # the server is gone, the rest can wait for the next flush
+                left.extend(paths[index + 1:])
+                break
+
+    if server is not None:
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+    return left
+
+def deliver(srv):
+    '''Send the outbox with the SMTP settings of get_smtp_conf(), True when nothing is left in it'''
+    if not outbox():
+        return True
+    left = flush_outbox(srv) if srv[0] is not None else outbox()
+    if left:
+        logging.error("{0} message(s) left in {1}, send them with --flush-outbox".format(len(left), outbox_dir))
+    return not left
+
+def info_message(sendto, msgbody):
+    from email.mime.text import MIMEText
+
+    msginfo = MIMEText(msgbody, "plain", "utf-8")
+    msginfo["To"] = sendto
+    msginfo["Subject"] = "AWS weekly key(s) rotation: {0}-{1}".format(
+        today.strftime("%Y%m%d"), future.strftime("%Y%m%d"))
+    return msginfo
+
+def roll_env(env, crypto, decrypted=None, min_age=None, max_age=None):
+    '''Rotate the access key of a single env, return the new key metadata or None when skipped
+
+    Raises NotDue when the age limits are given and the key isn't old enough.
+    '''
+    file_path = os.path.join(os.sep, aws_config_dir, "env.{0}.conf.asc".format(env))
+    key_id, access_key = get_current_key(env, file_path, crypto, decrypted)
+
+    if key_id is None:
+        logging.warning("Skipping environment '{}'".format(env))
+        return None
+
+    client = clients.client("iam", credentials={"aws_access_key_id": key_id, "aws_secret_access_key": access_key})
+    # the key in the env file is the old one, whatever order IAM lists the keys in
+    current_key_id = key_id
+
+    if min_age is not None or max_age is not None:
+        for key in client.list_access_keys()["AccessKeyMetadata"]:
+            if key["AccessKeyId"] == current_key_id and not is_due(key["CreateDate"], min_age, max_age):
+                raise NotDue(key["CreateDate"])
+
+    try:
+        resp = client.create_access_key()
+    except Exception as exc:
+        raise RuntimeError("Can't create a new access key: {0}".format(exc))
+
+    new_id = resp["AccessKey"]["AccessKeyId"]
+    new_key = resp["AccessKey"]["SecretAccessKey"]
+
+    contents = CREDENTIALS_FILE_TPL.format(id=new_id, key=new_key)
+
+    try:
+        encrypted = crypto.encrypt(contents)
+    except CryptoError as exc:
+        # the old key still works and is still in the env file, drop the new one
+        client.delete_access_key(AccessKeyId=new_id)
+        raise RuntimeError("Can't encrypt the new access key: {0}".format(exc))
+
+    try:
+        write_secret(file_path, encrypted)
+    except (IOError, OSError) as exc:
+        # the env file still holds the old key, which still works
+        client.delete_access_key(AccessKeyId=new_id)
+        raise RuntimeError("Can't save the new access key: {0}".format(exc))
+
+    # the env file holds the new key already, the env is rolled either way
+    try:
+        client.delete_access_key(AccessKeyId=current_key_id)
     except Exception as exc:
-        logging.error("Can't send email: {0}".format(exc))
+        logging.warning("Old key {0} of env {1} is still active, delete it by hand: {2}".format(
+            current_key_id, env, exc))
+
+    return resp["AccessKey"]
+
+def write_secret(file_path, contents):
+    '''Replace a file at once with a private one, the old contents stay when writing fails'''
+    tmp_path = "{0}.tmp".format(file_path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "w") as out:
+            out.write(contents)
+        os.replace(tmp_path, file_path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def user_file(user_name):
+    return os.path.join(users_dir, "user.{0}.conf.asc".format(user_name))
+
+def get_users(client, path_prefix, bucket, retries):
+    '''Page through all IAM users under path_prefix'''
+    marker = None
+    while True:
+        kwargs = {"PathPrefix": path_prefix}
+        if marker:
+            kwargs["Marker"] = marker
+        page = call_with_retry(lambda: client.list_users(**kwargs), bucket, retries)
+        for user in page["Users"]:
+            yield user
+        if not page.get("IsTruncated"):
+            return
+        marker = page["Marker"]
+
+def has_tags(client, user_name, tags, bucket, retries):
+    if not tags:
+        return True
+    # list_users doesn't return tags, they have to be asked for user by user
+    user_tags = {tag["Key"]: tag["Value"] for tag in
+                 call_with_retry(lambda: client.list_user_tags(UserName=user_name), bucket, retries)["Tags"]}
+    return all(user_tags.get(key) == value for key, value in tags.items())
+
+def roll_user(client, user_name, tags, min_age, max_age, crypto, bucket, retries, admin_key_id):
+    '''Rotate the access key of an IAM user when it is older than max_age, return the new key metadata or None
+
+    Raises AdminKeyDue when the key due is the one of the admin env itself.
+    '''
+    if not has_tags(client, user_name, tags, bucket, retries):
+        return None
+
+    keys = call_with_retry(lambda: client.list_access_keys(UserName=user_name), bucket, retries)["AccessKeyMetadata"]
+    stale = [key for key in keys if key["Status"] == "Active" and is_due(key["CreateDate"], min_age, max_age)]
+    if not stale:
+        return None
+    if any(key["AccessKeyId"] == admin_key_id for key in stale):
+        # the other workers are still using it
+        raise AdminKeyDue()
+    if len(stale) > 1 or len(keys) > 1:
+        # IAM allows two keys per user, there is no room for a new one
+        raise RuntimeError("has {0} access keys, rotate it by hand".format(len(keys)))
+
+    resp = call_with_retry(lambda: client.create_access_key(UserName=user_name), bucket, retries)
+    new_id = resp["AccessKey"]["AccessKeyId"]
+    contents = CREDENTIALS_FILE_TPL.format(id=new_id, key=resp["AccessKey"]["SecretAccessKey"])
+
+    try:
+        write_secret(user_file(user_name), crypto.encrypt(contents))
+    except (CryptoError, IOError, OSError) as exc:
+        call_with_retry(lambda: client.delete_access_key(UserName=user_name, AccessKeyId=new_id), bucket, retries)
+        raise RuntimeError("Can't save the new access key: {0}".format(exc))
+
+    call_with_retry(lambda: client.delete_access_key(UserName=user_name, AccessKeyId=stale[0]["AccessKeyId"]),
+                    bucket, retries)
+
+    return resp["AccessKey"]
+
+def roll_users(env, crypto, args):
+    '''Rotate stale keys of all IAM users with the credentials of an admin env'''
+    file_path = os.path.join(os.sep, aws_config_dir, "env.{0}.conf.asc".format(env))
+    try:
+        decrypted = crypto.unlock(file_path)
+        key_id, access_key = get_current_key(env, file_path, crypto, decrypted)
+    except (CryptoError, IOError) as exc:
+        logging.error(exc)
         sys.exit(1)
+    if key_id is None:
+        logging.error("No credentials for env '{}'".format(env))
+        sys.exit(1)
+
+    workers = max(1, args.parallel)
+    # every call on this client goes through call_with_retry, which retries throttling, 5xx and
+    # dropped connections within the rate limit, botocore retrying too would bypass it
+    client = clients.client("iam", credentials={"aws_access_key_id": key_id, "aws_secret_access_key": access_key},
+                            max_pool_connections=workers, retries={"mode": "standard", "total_max_attempts": 1})
+    bucket = TokenBucket(args.rate)
+    min_age = timedelta(days=args.min_age) if args.min_age is not None else None
+    max_age = timedelta(days=args.max_age if args.max_age is not None else 90)
+    tags = dict(tag.partition("=")[::2] for tag in args.tag)
+
+    if not os.path.isdir(users_dir):
+        os.makedirs(users_dir, 0o700)
+
+    results = {}
+    failed = {}
+    admin = None
+    # users are listed while the first ones are already being rotated
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for user in get_users(client, args.path_prefix, bucket, args.retries):
+            name = user["UserName"]
+            futures[pool.submit(roll_user, client, name, tags, min_age, max_age, crypto, bucket, args.retries,
+                                key_id)] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except AdminKeyDue:
+                admin = name
+            except Exception as exc:
+                logging.error("Can't roll key for user {0}: {1}".format(name, exc))
+                failed[name] = exc
+
+    # the admin key goes last, the new one is written to its env file
+    if admin is not None:
+        try:
+            results[admin] = roll_env(env, crypto, decrypted, min_age, max_age)
+        except Exception as exc:
+            logging.error("Can't roll key for user {0} of env {1}: {2}".format(admin, env, exc))
+            failed[admin] = exc
+        else:
+            ledger = read_ledger()
+            record(ledger, env, results[admin]["CreateDate"])
+            write_ledger(ledger)
+            print("Key of env {0} rolled, the new one is in {1}".format(env, file_path))
+
+    return sorted(futures.values()), results, failed
 
 def main():
-    available_envs = list(
-        map(lambda file: re.sub(r"^env.(.*).conf.asc$", r"\1", file),
-            filter(lambda file: file.startswith("env"),
-                   os.listdir(aws_config_dir))))
+    available_envs = get_available_envs()
     parser = argparse.ArgumentParser(
         description="Rolls AWS IAM Access Keys for all or specified env(s)",
         epilog="Copyright (C) 2016 Karolis Labrencis <karolis@labrencis.lt>")
-    parser.add_argument("-e", "--env", help="environment name", required=True,
+    parser.add_argument("-e", "--env", help="environment name",
                         choices=available_envs + ["all"])
     parser.add_argument("-s", "--send", help="Send an email with new keys to",
                         action="store", dest="sendkeysto")
@@ -112,68 +415,151 @@ def main():
                         action="store", dest="sendinfoto")
     parser.add_argument("-a", "--use-agent", action="store_true", help="Use GPG agent")
     parser.add_argument("--gpg-binary", help="GPG binary to use")
+    parser.add_argument("--flush-outbox", action="store_true",
+                        help="Send the emails left in {0} and exit".format(outbox_dir))
+    parser.add_argument("-p", "--parallel", type=int, help="How many envs (default: 1) or users (default: 8) are rotated at once")
+    parser.add_argument("-u", "--users", action="store_true",
+                        help="Rotate keys of all IAM users, using the env as admin credentials")
+    parser.add_argument("--path-prefix", default="/", help="Only users under this IAM path (with --users)")
+    parser.add_argument("--tag", action="append", default=[], metavar="KEY=VALUE",
+                        help="Only users with this tag, may be repeated (with --users)")
+    parser.add_argument("--min-age", type=int, help="Never rotate keys younger than this many days")
+    parser.add_argument("--max-age", type=int,
+                        help="Only rotate keys older than this many days (default: all, 90 with --users)")
+    parser.add_argument("-r", "--rate", type=float, default=10, help="IAM calls per second (with --users, default: 10)")
+    parser.add_argument("--retries", type=int, default=5, help="How many times a throttled call is retried (default: 5)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Print the latency of every AWS, gpg and SMTP call to stderr, "
+                             "with --trace=FILE also save the timeline to a .json (Chrome trace) or .jsonl file")
     parser.add_argument("-d", "--debug", action="store_true", help="Debug mode")
     parser.add_argument("-v", "--version", help="Print version", action="version",
                         version="%(prog)s 1.0")
-    args = parser.parse_args()
+    args = parser.parse_args(trace.argv())
+
+    if args.trace is not None:
+        trace.enable(args.trace)
 
     if args.debug:
         logging.basicConfig(format=logging.BASIC_FORMAT, level=logging.DEBUG)
         logging.info("Debug output.")
 
+    if args.flush_outbox:
+        # nothing to decrypt when there is nothing to send
+        srv = get_smtp_conf(smtp_conf_file, CryptoSession(args.use_agent, args.gpg_binary)) if outbox() else None
+        sys.exit(0 if deliver(srv) else 1)
+    if args.env is None:
+        parser.error("the following arguments are required: -e/--env")
+
+    if args.users:
+        if args.env == "all":
+            parser.error("--users needs a single admin env")
+        if args.sendkeysto:
+            parser.error("--users leaves the new keys in {0}, they can't be sent".format(users_dir))
+        if args.parallel is None:
+            args.parallel = 8
+    elif args.parallel is None:
+        args.parallel = 1
+
     if args.env == "all":
         args.env = available_envs
     else:
         args.env = [args.env]
 
-    if args.gpg_binary is not None:
-        gpg = gnupg.GPG(use_agent=args.use_agent, gpgbinary=args.gpg_binary)
-    else:
-        gpg = gnupg.GPG(use_agent=args.use_agent)
-    gpg.encoding = 'utf-8'
-    phrase = get_passphrase(args.use_agent)
+    if args.users:
+        crypto = CryptoSession(args.use_agent, args.gpg_binary)
+        users, results, failed = roll_users(args.env[0], crypto, args)
+        msgbody = ""
+        for name in users:
+            if name in failed:
+                msgbody += "Failed to roll key for user {}: {}\r\n".format(name, failed[name])
+            elif results.get(name) is not None:
+                msgbody += "Rolled key for user {}: AccessKeyId={}; CreateDate={}\r\n".format(
+                    name, "*" * 16 + results[name]["AccessKeyId"][-5:], results[name]["CreateDate"])
+        msgbody += "{0} users, {1} keys rolled, {2} failed\r\n".format(
+            len(users), sum(1 for result in results.values() if result is not None), len(failed))
+        print(msgbody)
+        delivered = True
+        if args.sendinfoto:
+            spool(info_message(args.sendinfoto, msgbody), args.sendinfoto)
+            delivered = deliver(get_smtp_conf(smtp_conf_file, crypto))
+        sys.exit(1 if failed or not delivered else 0)
+
+    min_age = timedelta(days=args.min_age) if args.min_age is not None else None
+    max_age = timedelta(days=args.max_age) if args.max_age is not None else None
+    ledger = read_ledger()
+
+    # envs rotated recently enough are skipped without gpg or AWS
+    not_due = {}
+    if min_age is not None or max_age is not None:
+        for env in args.env:
+            create_date = ledger_created(ledger, env)
+            if create_date is not None and not is_due(create_date, min_age, max_age):
+                not_due[env] = create_date
+    due = [env for env in args.env if env not in not_due]
+    for env in not_due:
+        logging.info("Key for env {0} created {1}, not due yet".format(env, not_due[env]))
+    if not due:
+        return
+
+    crypto = CryptoSession(args.use_agent, args.gpg_binary)
+
+    # check the passphrase once on the first env, instead of failing on every file
+    unlocked = {}
+    for env in due:
+        file_path = os.path.join(os.sep, aws_config_dir, "env.{0}.conf.asc".format(env))
+        if os.path.exists(file_path):
+            try:
+                unlocked[env] = crypto.unlock(file_path)
+            except CryptoError as exc:
+                logging.error(exc)
+                sys.exit(1)
+            break
+
+    # only needed once keys are rotated, --help shouldn't pay for the email package
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
 
     msgkeys = MIMEMultipart()
     envs = ""
     msgbody = ""
-
-    for env in args.env:
-        file_path = os.path.join(os.sep, aws_config_dir, "env.{0}.conf.asc".format(env))
-        key_id, access_key = get_current_key(env, file_path, gpg, phrase)
-
-        if key_id is None:
-            logging.warning("Skipping environment '{}'".format(env))
+    results = {}
+    failed = {}
+
+    # one broken env must not stop the others
+    with ThreadPoolExecutor(max_workers=max(1, args.parallel)) as pool:
+        futures = {pool.submit(roll_env, env, crypto, unlocked.pop(env, None), min_age, max_age): env for env in due}
+        for future in as_completed(futures):
+            env = futures[future]
+            try:
+                results[env] = future.result()
+            except NotDue as exc:
+                not_due[env] = exc.create_date
+            except Exception as exc:
+                logging.error("Can't roll key for env {0}: {1}".format(env, exc))
+                failed[env] = exc
+
+    for env in due:
+        if env in not_due:
+            record(ledger, env, not_due[env])
+        elif results.get(env) is not None:
+            record(ledger, env, results[env]["CreateDate"])
+    write_ledger(ledger)
+
+    # report in the order envs were given, whichever finished first
+    for env in due:
+        if env in failed:
+            msgbody += "Failed to roll key for env {}: {}\r\n".format(env, failed[env])
+            continue
+        if results.get(env) is None:
             continue
-
-        client = boto3.client("iam", aws_access_key_id=key_id, aws_secret_access_key=access_key)
-        current_key_id = \
-            client.list_access_keys()["AccessKeyMetadata"][0]["AccessKeyId"]
-
-        try:
-            resp = client.create_access_key()
-        except Exception as exc:
-            logging.error("Can't create a new access key: {0}".format(exc))
-            sys.exit(1)
-
-        new_id = resp["AccessKey"]["AccessKeyId"]
-        new_key = resp["AccessKey"]["SecretAccessKey"]
-
-        contents = CREDENTIALS_FILE_TPL.format(id=new_id, key=new_key)
-
-        private_key = gpg.list_keys(True)
-        encrypted = gpg.encrypt(contents, private_key[0]["uids"][0])
-
-        with open(file_path, "w") as out:
-            out.write(str(encrypted))
-
-        client.delete_access_key(AccessKeyId=current_key_id)
 
         msgbody += "Rolled key for env {}: AccessKeyId={}; CreateDate={}\r\n".format(
-            env, "*" * 16 + resp["AccessKey"]["AccessKeyId"][-5:],
-            resp["AccessKey"]["CreateDate"]
+            env, "*" * 16 + results[env]["AccessKeyId"][-5:],
+            results[env]["CreateDate"]
         )
 
         if args.sendkeysto:
+            file_path = os.path.join(os.sep, aws_config_dir, "env.{0}.conf.asc".format(env))
             with open(file_path, "rb") as attach:
                 part1 = MIMEApplication(attach.read(), Name="env.{0}.conf.asc".format(env))
                 part1["Content-Disposition"] = 'attachment; filename={}'.format(
@@ -184,29 +570,25 @@ def main():
     print(msgbody)
     vars = dict()
 
+    if not msgbody:
+        return
+
+    # the keys are rotated already, the emails are queued first so a mail server
+    # failure can't lose them, and go out together over one SMTP session
+    delivered = True
     if args.sendkeysto or args.sendinfoto:
-        smtpconf = "{}/smtp.cfg.asc".format(aws_config_dir)
-        srv = get_smtp_conf(smtpconf, gpg, phrase)
-
-    if args.sendkeysto:
-        msgkeys["To"] = args.sendkeysto
-        msgkeys["From"] = srv[0]
-        msgkeys["Subject"] = "AWS keys: {}".format(envs)
-
-        send(srv, args.sendkeysto, msgkeys.as_string())
-        addr_list = re.split(r',\s*', args.sendkeysto)
-        print("Keys sent to: {0}".format(', '.join(addr_list)))
-
-    if args.sendinfoto:
-        msginfo = MIMEText(msgbody, "plain", "utf-8")
-        msginfo["To"] = args.sendinfoto
-        msginfo["From"] = srv[0]
-        msginfo["Subject"] = "AWS weekly key(s) rotation: {0}-{1}".format(
-            today.strftime("%Y%m%d"), future.strftime("%Y%m%d"))
-
-        send(srv, args.sendinfoto, msginfo.as_string())
-        addr_list = re.split(r',\s*', args.sendinfoto)
-        print("Info sent to: {0}".format(', '.join(addr_list)))
+        if args.sendkeysto and envs:
+            msgkeys["To"] = args.sendkeysto
+            msgkeys["Subject"] = "AWS keys: {}".format(envs)
+            spool(msgkeys, args.sendkeysto)
+
+        if args.sendinfoto:
+            spool(info_message(args.sendinfoto, msgbody), args.sendinfoto)
+
+        delivered = deliver(get_smtp_conf(smtp_conf_file, crypto))
+
+    if failed or not delivered:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -2,9 +2,25 @@ if [ -d "$HOME/.local/bin" ] ; then
     PATH="$HOME/.local/bin:$PATH"
 fi
 
+# Reads ~/.aws/.envs (kept up to date by the python scripts) into
+# __AWS_ENVS and __AWS_ACTIVE. Builtins only, no forks on every TAB or prompt.
+function __aws_index() {
+    local key value
+    __AWS_ENVS=""
+    __AWS_ACTIVE=""
+    [ -r "$HOME/.aws/.envs" ] || return 1
+    while read -r key value; do
+        case "$key" in
+            envs) __AWS_ENVS="$value" ;;
+            active) __AWS_ACTIVE="$value" ;;
+        esac
+    done < "$HOME/.aws/.envs"
+}
+
 function __awsenv_ps1() {
     if [ -e "$HOME/.aws/credentials" ]; then
-        ps="<$(cat $HOME/.aws/.env 2>/dev/null)> "
+        __aws_index || { read -r __AWS_ACTIVE < "$HOME/.aws/.env"; } 2>/dev/null
+        ps="<$__AWS_ACTIVE> "
     fi
     if [ -n "$AWS_ENV" ]; then
         ps="<$AWS_ENV> "
@@ -17,8 +33,20 @@ function __aws_envs() {
     local words=( "${COMP_WORDS[@]}" )
     local word="${COMP_WORDS[COMP_CWORD]}"
     words=("${words[@]:1}")
-    local completions="$(ls $HOME/.aws/env*asc | cut -d "." -f 3)"
-    COMPREPLY=( $(compgen -W "$completions" -- "$word") )
+    local completions
+    if __aws_index && [[ "$HOME/.aws/.envs" -nt "$HOME/.aws" ]]; then
+        completions="$__AWS_ENVS"
+    else
+        # the index is missing or stale, glob instead
+        local files=( "$HOME"/.aws/env.*.conf.asc )
+        [ -e "${files[0]}" ] || files=()
+        files=( "${files[@]##*/env.}" )
+        completions="${files[*]%.conf.asc}"
+    fi
+    local env
+    for env in $completions; do
+        [[ "$env" == "$word"* ]] && COMPREPLY+=( "$env" )
+    done
 }
 
 function awsroll() {
@@ -27,9 +55,9 @@ function awsroll() {
 
 function awsenv() {
     if [[ $1 == "unset" ]]; then
-        unset AWS_ENV AWS_ACCESS_KEY_ID AWS_SECRET_ACCESS_KEY
+        unset AWS_ENV AWS_ACCESS_KEY_ID AWS_SECRET_ACCESS_KEY AWS_SESSION_TOKEN
     else
-        eval $(aws-env-update.py -x -a -e ${1})
+        eval $(aws-env-update.py -x -a -e ${1} "${@:2}")
     fi
 }
 
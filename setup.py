@@ -30,6 +30,7 @@ setup(
     packages=find_packages(),
     scripts=[
         'bin/aws-env-update.py',
+        'bin/aws-env-agent.py',
         'bin/aws-roll-keys.py',
         'bin/aws-list-ec2.py',
         'bin/aws-clean-eb-versions.py',